@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Compare the wall-clock time of the gradient evaluations with the static
+partitioning of the shots (one task per process) and with the dynamic scheduling
+(tasks of shots_per_task shots, balanced by dask as they complete). Uses the
+cluster and the fwi configuration of config/config.yaml.
+
+Usage:
+    python3 benchmark_scheduling.py [-n 3]
+'''
+
+import json
+import time
+import argparse
+import numpy as np
+import h5py
+
+from dask_cluster import DaskCluster
+
+
+def time_evaluations(dc, X, scheduling, nevals):
+    '''
+    Returns the times (s) of nevals gradient evaluations with the given scheduling,
+    after one evaluation to warm up the workers
+    '''
+    dc.config_values['scheduling'] = scheduling
+    DaskCluster.gen_grad_cluster.counter = 0
+    dc.gen_grad_cluster(X)
+    times = []
+    for _ in range(nevals):
+        tic = time.time()
+        dc.gen_grad_cluster(X)
+        times.append(time.time() - tic)
+    return np.array(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare static and dynamic scheduling of the shots')
+    parser.add_argument('-n', '--nevals', type=int, default=3,
+                        help='number of timed gradient evaluations per scheduling')
+    args = parser.parse_args()
+
+    dc = DaskCluster()
+    parfile_path = dc.config_values['solver_params']['parfile_path']
+    with h5py.File(parfile_path + 'vp_start.h5', 'r') as f:
+        v0 = f['vp_start'][()]
+        metadata = json.loads(f['metadata'][()])
+    dc.config_values['solver_params']['origin'] = (*metadata['origin'],)
+    dc.config_values['solver_params']['spacing'] = (*metadata['spacing'],)
+    dc.config_values['solver_params']['shape'] = (*metadata['shape'],)
+    X = 1.0 / (v0.reshape(-1).astype(np.float32))**2
+
+    times = {s: time_evaluations(dc, X, s, args.nevals) for s in ('static', 'dynamic')}
+    print("{} shots, shots_per_task {}".format(len(dc.tasks_dict),
+                                               dc.config_values['shots_per_task']))
+    for s, t in times.items():
+        print("{:8s}: mean {:8.2f} s, min {:8.2f} s per evaluation".format(
+            s, t.mean(), t.min()))
+    print("Dynamic scheduling speedup: {:.2f}x".format(
+        times['static'].mean() / times['dynamic'].mean()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Compare the per-shot load latency of the SEG-Y files and of the HDF5 shot store
+(see segy_to_hdf5.py) of a shot directory.
+
+Usage:
+    python3 benchmark_shot_io.py ./marmousi2/shots/ [-r 5]
+'''
+
+import os
+import time
+import argparse
+import numpy as np
+
+from utils import make_tasks_table, make_hdf5_lookup_table, load_shot
+
+
+def time_loads(tbl, repeats):
+    '''
+    Returns the load times (s) of every shot of the lookup table tbl
+    '''
+    times = []
+    for _ in range(repeats):
+        for v in tbl.values():
+            tic = time.perf_counter()
+            load_shot(v['filename'], v['Trace_Position'], v['Num_Traces'])
+            times.append(time.perf_counter() - tic)
+    return np.array(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the per-shot load latency of SEG-Y and HDF5')
+    parser.add_argument('segy_dir', help='directory of the SEG-Y files')
+    parser.add_argument('-s', '--store', default=None,
+                        help='HDF5 shot store (default: <segy_dir>/shots.h5)')
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help='number of passes over the shots')
+    args = parser.parse_args()
+
+    segy_files = [f for f in os.listdir(args.segy_dir) if f.endswith('.segy')]
+    segy_files = [os.path.join(args.segy_dir, sub) for sub in segy_files]
+    h5_file = args.store or os.path.join(args.segy_dir, 'shots.h5')
+
+    tables = {'segy': make_tasks_table(segy_files),
+              'hdf5': make_hdf5_lookup_table(h5_file)}
+    for name, tbl in tables.items():
+        t = time_loads(tbl, args.repeats)
+        print("{:5s}: {} loads, mean {:.2f} ms, median {:.2f} ms, max {:.2f} ms".format(
+            name, len(t), 1e3 * t.mean(), 1e3 * np.median(t), 1e3 * t.max()))
+
+
+if __name__ == "__main__":
+    main()
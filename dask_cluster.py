@@ -9,23 +9,357 @@ import time
 import yaml
 import json
 import h5py
+import hashlib
 import gc
+import queue
+import threading
+from collections import OrderedDict
+import resource
+import psutil
 
 from dask_jobqueue import SLURMCluster
-from dask.distributed import Client, LocalCluster
-
-from devito import Function, TimeFunction, Inc, Eq, Operator, Grid, configuration
+from dask.distributed import Client, LocalCluster, WorkerPlugin, get_worker
+from dask.distributed import as_completed, get_task_stream
+from dask.utils import parse_bytes
+from scipy.signal import butter, sosfilt
+
+from devito import Function, TimeFunction, Inc, Eq, Operator, configuration
+from devito import DevitoCheckpoint, CheckpointOperator, Revolver
+from devito import Dimension, SubDimension, ConditionalDimension, DefaultDimension
+from devito import Buffer, solve, cos, sin
 from examples.seismic import AcquisitionGeometry, TimeAxis, Receiver, SeismicModel
+from examples.seismic import PointSource
 from examples.seismic.acoustic import AcousticWaveSolver
 from examples.seismic.acoustic.operators import iso_stencil
 
-from utils import segy_write, make_lookup_table, load_shot, humanbytes, expand_array
-import cloudpickle as pickle
+from utils import segy_traces, segy_create, segy_write_traces, segy_index
+from utils import save_segy_index, create_hdf5_store, hdf5_write_shot
+from utils import make_tasks_table, make_hdf5_lookup_table, load_shot
+from utils import humanbytes, expand_array, resample_model
+from wavefield_storage import WavefieldStore, MemmapStore, make_store
 #import dask
 
 #dask.config.set({'logging.distributed': 'error'})
 configuration['log-level'] = 'ERROR' #'DEBUG' or 'INFO'
 
+# Relative source illumination below which the gradient of the boundary saving,
+# compressed and DFT modes is set to zero
+ILLUM_CUTOFF = 1e-6
+
+# Memory limit of the workers of a LocalCluster
+LOCAL_MEMORY_LIMIT = '5GB'
+
+# Default memory budget of the observed data cache of every worker
+SHOT_CACHE_MEMORY = '1GB'
+
+# Oversampling of the highest frequency of the source by the subsampled forward
+# wavefield of time_subsampling: auto
+OVERSAMPLING = 2.
+
+# Order of the low-pass filter of the frequency bands
+LOWPASS_ORDER = 6
+
+# Number of points kept by the objective function of the optimizers
+OBJECTIVE_HISTORY = 8
+
+
+class SolverCache(WorkerPlugin):
+    '''
+    Worker plugin that keeps the solvers and devito Operators built by the worker, so
+    that they are built and compiled once per worker and reused across evaluations,
+    inversion runs and the forward and fwi phases. The entries are keyed by the
+    part of the specification (see DaskCluster.solver_spec) they depend on.
+    '''
+    name = 'solver_cache'
+
+    # Keys of the specification the solver depends on
+    solver_keys = ('parfile_path', 'space_order', 'nbl', 'dtype', 't0', 'tn', 'f0',
+                   'nrecs', 'shape', 'spacing', 'aperture_shape')
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        '''
+        Returns the entry for key, calling build to create it on a miss
+        '''
+        if key in self.entries:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.entries[key] = build()
+        return self.entries[key]
+
+    def stats(self):
+        return self.hits, self.misses
+
+    @staticmethod
+    def solver_key(spec):
+        return json.dumps({k: spec.get(k) for k in SolverCache.solver_keys},
+                          sort_keys=True)
+
+    @staticmethod
+    def operators_key(spec):
+        # The time step of an aperture (see DaskCluster.aperture_results) follows the
+        # current model, which the Operators do not depend on
+        return json.dumps({k: v for k, v in spec.items() if k != 'aperture_dt'},
+                          sort_keys=True, default=str)
+
+
+# Cache used outside of the workers
+SolverCache.local = SolverCache()
+
+
+class BufferPool(WorkerPlugin):
+    '''
+    Worker plugin that keeps the devito Functions (wavefields, receivers, gradients)
+    of the worker functions, so that they are zeroed and reused instead of being
+    allocated for every task. Every group of buffers is keyed by the grid shape,
+    number of time steps and space order, and it is released when another key is
+    requested (e.g. when the time step of the model changes). The resident memory
+    of the worker is recorded after every task.
+    '''
+    name = 'buffer_pool'
+
+    def __init__(self):
+        self.groups = {}
+        self.steady_rss = 0
+
+    def get(self, group, key, build):
+        '''
+        Returns the buffers of group for key, calling build to create them on a miss
+        '''
+        if group in self.groups and self.groups[group][0] == key:
+            return self.groups[group][1]
+        # Release the previous buffers before allocating the new ones
+        self.groups.pop(group, None)
+        gc.collect()
+        self.groups[group] = (key, build())
+        return self.groups[group][1]
+
+    def transition(self, key, start, finish, **kwargs):
+        if start == 'executing':
+            self.steady_rss = psutil.Process().memory_info().rss
+
+    def memory_stats(self):
+        '''
+        Peak resident memory of the worker and resident memory after the last task
+        '''
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return peak, self.steady_rss
+
+
+BufferPool.local = BufferPool()
+
+
+class ShotCache(WorkerPlugin):
+    '''
+    Worker plugin that keeps the observed data of the shots, resampled to the time
+    step of the modelling, so that repeated evaluations read and interpolate them
+    only once. The least recently used shots are evicted to stay within a memory
+    budget.
+
+    Args:
+        budget (int): Memory budget in bytes
+    '''
+    name = 'shot_cache'
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        '''
+        Returns the data for key, calling load to read them on a miss
+        '''
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        data = load()
+        data.flags.writeable = False
+        if data.nbytes <= self.budget:
+            while self.nbytes + data.nbytes > self.budget:
+                _, old = self.entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+            self.entries[key] = data
+            self.nbytes += data.nbytes
+        return data
+
+    def stats(self):
+        return self.hits, self.misses, self.nbytes
+
+
+ShotCache.local = ShotCache(parse_bytes(SHOT_CACHE_MEMORY))
+
+
+class ShotWriter(WorkerPlugin):
+    '''
+    Worker plugin that writes the shots of the forward modelling in a background
+    thread, so that the worker propagates the next shot while the previous one is
+    written. At most depth shots wait to be written; submit blocks beyond that. The
+    writes outlive the task that submitted them, so that the last shots of a task
+    are written during the next task; flush waits for them (see
+    DaskCluster.gen_shots_cluster).
+
+    Args:
+        depth (int, optional): Number of shots waiting to be written. Default 2
+    '''
+    name = 'shot_writer'
+
+    def __init__(self, depth=2):
+        self.depth = depth
+        self.queue = None
+        self.error = None
+
+    def _run(self):
+        while True:
+            write, args = self.queue.get()
+            try:
+                if self.error is None:
+                    write(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def submit(self, write, *args):
+        '''
+        Queues the call write(*args). The error of an earlier write, if any, is
+        raised instead
+        '''
+        if self.error is not None:
+            self.flush()
+        if self.queue is None:
+            self.queue = queue.Queue(maxsize=self.depth)
+            threading.Thread(target=self._run, name=self.name, daemon=True).start()
+        self.queue.put((write, args))
+
+    def flush(self):
+        '''
+        Waits until the queued shots are written, and raises the first error of the
+        writes, if any
+        '''
+        if self.queue is not None:
+            self.queue.join()
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def teardown(self, worker):
+        self.flush()
+
+
+ShotWriter.local = ShotWriter()
+
+
+def worker_plugin(plugin_class):
+    '''
+    Returns the instance of a plugin of the current worker, or the local instance
+    of the class when not running in a worker
+    '''
+    try:
+        return get_worker().plugins[plugin_class.name]
+    except ValueError:
+        return plugin_class.local
+
+
+class MemoizedObjective:
+    '''
+    Objective function of the optimizers that keeps the misfit and the gradient of
+    the last points it evaluated, so that a point the optimizer asks for again (e.g.
+    the gradient after the value at the same point, or a point a line search has
+    already visited) is not simulated again. The value is evaluated with the
+    gradient, or with forward simulations only with forward_value (see
+    DaskCluster.gen_misfit_cluster), in which case the gradient of the point is
+    evaluated when it is asked for. The points are keyed by a hash of the float32
+    model, which the workers simulate, and by the mini-batch of shots (see
+    DaskCluster.new_shot_batch). The least recently used points are evicted beyond
+    history points. The solver time saved is the time of the evaluations whose
+    results were reused.
+
+    Args:
+        dc (DaskCluster): cluster that evaluates the misfit and gradient (see
+            DaskCluster.gen_grad_cluster)
+        history (int, optional): Number of points kept. Default OBJECTIVE_HISTORY
+        forward_value (bool, optional): Whether the value is evaluated without the
+            gradient. Default False
+    '''
+
+    def __init__(self, dc, history=OBJECTIVE_HISTORY, forward_value=False):
+        self.dc = dc
+        self.history = history
+        self.forward_value = forward_value
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.
+
+    def key(self, x):
+        # The first mini-batch is drawn before the key is taken, not by the first
+        # evaluation (see DaskCluster.shot_batch_tasks)
+        if self.dc.shot_batch is None:
+            self.dc.new_shot_batch()
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        return self.dc.batch_count, hashlib.blake2b(x, digest_size=16).digest()
+
+    def lookup(self, x, gradient=True):
+        '''
+        Returns the kept misfit, gradient (None if only the value was evaluated) and
+        evaluation time of x, evaluating them if they are not kept
+        '''
+        key = self.key(x)
+        entry = self.entries.get(key)
+        if entry is not None and (entry[1] is not None or not gradient):
+            self.hits += 1
+            self.entries.move_to_end(key)
+            self.time_saved += entry[2]
+            return entry
+        self.misses += 1
+        tic = time.time()
+        if gradient or not self.forward_value:
+            f, g = self.dc.gen_grad_cluster(x)
+        else:
+            f, g = self.dc.gen_misfit_cluster(x), None
+        entry = self.entries[key] = f, g, time.time() - tic
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.history:
+            self.entries.popitem(last=False)
+        return entry
+
+    def __call__(self, x):
+        '''
+        Returns the misfit and the gradient at x (see DaskCluster.gen_grad_cluster)
+        '''
+        f, g, _ = self.lookup(x)
+        # The optimizers may update the gradient in place
+        return f, g.copy()
+
+    def value(self, x):
+        '''
+        Returns the misfit at x
+        '''
+        return self.lookup(x, gradient=False)[0]
+
+    def gradient(self, x):
+        '''
+        Returns the gradient at x
+        '''
+        return self(x)[1]
+
+    def report(self):
+        '''
+        Prints the number of evaluations served from the kept points
+        '''
+        print("Objective memo: {} hits, {} misses, {:.2f} s of solver time "
+              "saved".format(self.hits, self.misses, self.time_saved))
+
 
 class DaskCluster:
     '''
@@ -52,9 +386,107 @@ class DaskCluster:
             self.config_values["processes"] = 1
         if "memory" not in self.config_values:
             self.config_values["memory"] = 320
+        if "shot_cache_memory" not in self.config_values:
+            self.config_values["shot_cache_memory"] = SHOT_CACHE_MEMORY
+        if "scheduling" not in self.config_values:
+            self.config_values["scheduling"] = "dynamic"
+        if self.config_values["scheduling"] not in ("static", "dynamic", "affinity"):
+            raise ValueError("Invalid scheduling: {}".format(
+                self.config_values["scheduling"]))
+        if "shots_per_task" not in self.config_values:
+            self.config_values["shots_per_task"] = 1
+        if "shot_batch_size" not in self.config_values:
+            self.config_values["shot_batch_size"] = None
+        if "shot_sampling" not in self.config_values:
+            self.config_values["shot_sampling"] = "random"
+        if self.config_values["shot_sampling"] not in ("random", "cyclic"):
+            raise ValueError("Invalid shot_sampling: {}".format(
+                self.config_values["shot_sampling"]))
+        if "shot_sampling_seed" not in self.config_values:
+            self.config_values["shot_sampling_seed"] = 0
+        if "supershot_size" not in self.config_values:
+            self.config_values["supershot_size"] = 1
+        if "supershot_encoding" not in self.config_values:
+            self.config_values["supershot_encoding"] = "polarity"
+        if self.config_values["supershot_encoding"] not in ("polarity", "time_shift",
+                                                            "both"):
+            raise ValueError("Invalid supershot_encoding: {}".format(
+                self.config_values["supershot_encoding"]))
+        if "supershot_max_delay" not in self.config_values:
+            self.config_values["supershot_max_delay"] = 500.
+        if "multiscale_bands" not in self.config_values:
+            self.config_values["multiscale_bands"] = [None]
+        if "multiscale_maxiter" not in self.config_values:
+            self.config_values["multiscale_maxiter"] = 10
+        if "multiscale_optimizer" not in self.config_values:
+            self.config_values["multiscale_optimizer"] = "scipy"
+        if self.config_values["multiscale_optimizer"] not in ("scipy", "nlopt",
+                                                              "sotb"):
+            raise ValueError("Invalid multiscale_optimizer: {}".format(
+                self.config_values["multiscale_optimizer"]))
+        if "points_per_wavelength" not in self.config_values:
+            self.config_values["points_per_wavelength"] = 8
         if "job_extra" not in self.config_values:
             self.config_values["job_extra"] = ['-e slurm-%j.err', '-o slurm-%j.out',
                                                '--job-name="dask_task"']
+        solver_params = self.config_values["solver_params"]
+        if "gradient_mode" not in solver_params:
+            solver_params["gradient_mode"] = "full"
+        if "n_checkpoints" not in solver_params:
+            solver_params["n_checkpoints"] = None
+        if "compression" not in solver_params:
+            solver_params["compression"] = "float16"
+        if "compression_tol" not in solver_params:
+            solver_params["compression_tol"] = 1e-3
+        if "compression_check" not in solver_params:
+            solver_params["compression_check"] = False
+        if "stream_chunk" not in solver_params:
+            solver_params["stream_chunk"] = 32
+        if "time_subsampling" not in solver_params:
+            solver_params["time_subsampling"] = 1
+        subsampling = solver_params["time_subsampling"]
+        if subsampling != "auto" and not (isinstance(subsampling, int) and
+                                          subsampling >= 1):
+            raise ValueError("time_subsampling must be 'auto' or a positive integer")
+        if "dft_frequencies" not in solver_params:
+            solver_params["dft_frequencies"] = None
+        if "dft_nfreq" not in solver_params:
+            solver_params["dft_nfreq"] = None
+        if "scratch_path" not in solver_params:
+            solver_params["scratch_path"] = None
+        if "spill_fraction" not in solver_params:
+            solver_params["spill_fraction"] = 0.5
+        if "shot_format" not in solver_params:
+            solver_params["shot_format"] = "auto"
+        if solver_params["shot_format"] not in ("auto", "segy", "hdf5"):
+            raise ValueError("Invalid shot_format: {}".format(
+                solver_params["shot_format"]))
+        if "adaptive_record_length" not in solver_params:
+            solver_params["adaptive_record_length"] = False
+        if "window_velocity" not in solver_params:
+            solver_params["window_velocity"] = None
+        if "window_length" not in solver_params:
+            solver_params["window_length"] = 0.
+        if "max_frequency" not in solver_params:
+            solver_params["max_frequency"] = None
+        if "source_scale" not in solver_params:
+            solver_params["source_scale"] = 1.
+        if "aperture_margin" not in solver_params:
+            solver_params["aperture_margin"] = None
+        if "propagation_batch" not in solver_params:
+            solver_params["propagation_batch"] = 1
+        if not (isinstance(solver_params["propagation_batch"], int) and
+                solver_params["propagation_batch"] >= 1):
+            raise ValueError("propagation_batch must be a positive integer")
+        if "shot_output" not in solver_params:
+            solver_params["shot_output"] = "per_shot"
+        if solver_params["shot_output"] not in ("per_shot", "segy", "hdf5"):
+            raise ValueError("Invalid shot_output: {}".format(
+                solver_params["shot_output"]))
+        if solver_params["gradient_mode"] not in ("full", "checkpointing", "boundary",
+                                                  "compressed", "dft", "out_of_core"):
+            raise ValueError("Invalid gradient_mode: {}".format(
+                solver_params["gradient_mode"]))
 
         are_true = (self.config_values["forward"] and self.config_values["fwi"])
         if are_true:
@@ -69,7 +501,7 @@ class DaskCluster:
             # single-threaded execution, as this is actually best for the workload
             cluster = LocalCluster(n_workers=self.config_values["n_workers"],
                                    threads_per_worker=1,
-                                   memory_limit='5GB', death_timeout=60,
+                                   memory_limit=LOCAL_MEMORY_LIMIT, death_timeout=60,
                                    resources={'process': 1})
         else:
             cluster = SLURMCluster(queue=self.config_values["queue"],
@@ -88,6 +520,18 @@ class DaskCluster:
         # Wait for cluster to start
         time.sleep(10)
         self.client = Client(cluster)
+        self.client.register_plugin(SolverCache())
+        self.client.register_plugin(BufferPool())
+        shot_cache_memory = self.config_values["shot_cache_memory"]
+        self.client.register_plugin(ShotCache(
+            parse_bytes(shot_cache_memory) if shot_cache_memory else 0))
+        self.client.register_plugin(ShotWriter())
+        # Worker that ran every task in the affinity scheduling
+        self.affinity = {}
+        # Shots of the current mini-batch (see new_shot_batch)
+        self.shot_batch = None
+        self.batch_count = 0
+        self.batch_rng = np.random.default_rng(self.config_values["shot_sampling_seed"])
         # initialize tasks dictionary
         self._set_tasks_from_files()
 
@@ -116,27 +560,163 @@ class DaskCluster:
             self.tasks_dict = {i: {'Source': src_coord[i],
                                    'Receivers': rec_coord} for i in range(nshots)}
         else:
-            # Read chunk of shots
+            # Read chunk of shots, from the shot store (see segy_to_hdf5.py) if
+            # there is one, or from the SEG-Y files
+            shot_format = self.config_values['solver_params']['shot_format']
             segy_dir_files = self.config_values['solver_params']['shotfile_path']
-            segy_files = [f for f in os.listdir(segy_dir_files) if f.endswith('.segy')]
-            segy_files = [segy_dir_files + sub for sub in segy_files]
+            h5_files = sorted(f for f in os.listdir(segy_dir_files) if f.endswith('.h5'))
+            if shot_format == 'hdf5' and not h5_files:
+                raise FileNotFoundError(
+                    errno.ENOENT, "No .h5 shot store in", segy_dir_files)
 
             # Create a dictionary of shots
-            self.tasks_dict = {}
-            for count, sfile in enumerate(segy_files, start=1):
-                self.tasks_dict.update({str(count) if k == 1 else k: v
-                                       for k, v in make_lookup_table(sfile).items()})
+            if h5_files and shot_format != 'segy':
+                self.tasks_dict = make_hdf5_lookup_table(
+                    os.path.join(segy_dir_files, h5_files[0]))
+            else:
+                segy_files = [f for f in os.listdir(segy_dir_files) if f.endswith('.segy')]
+                segy_files = [segy_dir_files + sub for sub in segy_files]
+                self.tasks_dict = make_tasks_table(segy_files)
+
+    def create_task_list(self, shot_master_list=None):
+        '''
+        Breaks the shots into the lists of shots of the tasks. With the dynamic and
+        affinity schedulings every task holds shots_per_task shots, so that there are
+        more tasks than processes and dask balances the load among the workers as
+        tasks complete. With the static scheduling there is a task per process (see
+        create_break_list).
+
+        Args:
+            shot_master_list (list, optional): Shots to break up. Default all shots
 
-    def create_break_list(self):
+        Returns:
+            task_list (list): List with sublists of dictionaries
+        '''
+        if shot_master_list is None:
+            shot_master_list = self.create_shot_list()
+        if self.config_values["scheduling"] == "static":
+            return self.create_break_list(shot_master_list)
+        b = self.config_values["shots_per_task"]
+        return [shot_master_list[i:i+b] for i in range(0, len(shot_master_list), b)]
+
+    def new_shot_batch(self):
+        '''
+        Draws the shots of the next mini-batch of shot_batch_size shots, which the
+        gradient evaluations use until the next draw, so that the evaluations of a
+        line search see the same objective function. The shots are drawn at random
+        without replacement (shot_sampling: random, seeded by shot_sampling_seed),
+        or the batches cycle through interleaved subsets of the shots that cover
+        all the shots once per cycle (shot_sampling: cyclic). Without
+        shot_batch_size all shots are used. With supershot_size larger than 1, the
+        shots of the mini-batch are combined into supershots with new encodings (see
+        encode_shots). The batch is only drawn again, and counted in batch_count,
+        when it changes (see shot_batch_changes).
+        '''
+        if self.shot_batch is not None and not self.shot_batch_changes():
+            return
+        shots = self.create_shot_list()
+        b = self.config_values["shot_batch_size"]
+        if not b or b >= len(shots):
+            batch = shots
+        elif self.config_values["shot_sampling"] == "cyclic":
+            nbatches = -(-len(shots) // b)
+            batch = shots[self.batch_count % nbatches::nbatches]
+        else:
+            batch = [shots[i] for i in sorted(self.batch_rng.choice(len(shots), b,
+                                                                    replace=False))]
+        self.batch_count += 1
+        self.shot_batch = self.encode_shots(batch)
+
+    def shot_batch_changes(self):
+        '''
+        Whether new_shot_batch draws other shots or encodings, i.e. whether
+        shot_batch_size is smaller than the number of shots or supershot_size is
+        larger than 1
+        '''
+        b = self.config_values["shot_batch_size"]
+        return bool(b and b < len(self.tasks_dict)) or \
+            self.config_values["supershot_size"] > 1
+
+    def encode_shots(self, shots):
+        '''
+        Combines the shots into supershots of supershot_size shots, which are
+        simulated at once by the workers: the source of every shot is fired with a
+        random polarity (supershot_encoding: polarity), a random delay of up to
+        supershot_max_delay ms (time_shift) or both, and the observed data of the
+        shots are encoded and added up the same way. Only shots recorded by the same
+        receivers (fixed spread) are combined, and every supershot gathers shots
+        spread along the survey.
+
+        Args:
+            shots (list): Shots to combine
+
+        Returns:
+            supershots (list): Dictionaries with the shots ('Shots') and sources
+                ('Source') of every supershot, their encodings ('Polarity' and
+                'Delay') and the common receivers. The shots themselves if
+                supershot_size is 1
+        '''
+        k = self.config_values["supershot_size"]
+        if k == 1:
+            return shots
+        encoding = self.config_values["supershot_encoding"]
+        spreads = {}
+        for d in shots:
+            rec_coord = np.asarray(d['Receivers'])
+            spreads.setdefault((rec_coord.shape, rec_coord.tobytes()), []).append(d)
+        supershots = []
+        for spread in spreads.values():
+            n = -(-len(spread) // k)
+            for members in (spread[j::n] for j in range(n)):
+                polarity = np.ones(len(members))
+                delay = np.zeros(len(members))
+                if encoding in ("polarity", "both"):
+                    polarity = self.batch_rng.choice([-1., 1.], len(members))
+                if encoding in ("time_shift", "both"):
+                    delay = self.batch_rng.uniform(
+                        0., self.config_values["supershot_max_delay"], len(members))
+                supershots.append({
+                    'id': '+'.join(str(d['id']) for d in members),
+                    'Source': np.vstack([np.atleast_2d(d['Source']) for d in members]),
+                    'Receivers': members[0]['Receivers'],
+                    'Shots': members, 'Polarity': polarity, 'Delay': delay})
+        return supershots
+
+    def shot_batch_tasks(self):
+        '''
+        Tasks of the shots of the current mini-batch (see new_shot_batch)
+
+        Returns:
+            task_list (list): List with sublists of dictionaries
+            scale (float): Number of shots over number of shots of the mini-batch, the
+                factor that makes misfit and gradient estimates of the full sums
+        '''
+        if self.shot_batch is None:
+            self.new_shot_batch()
+        nshots = sum(len(d.get('Shots', [d])) for d in self.shot_batch)
+        return self.create_task_list(self.shot_batch), len(self.tasks_dict) / nshots
+
+    def create_shot_list(self):
+        '''
+        Converts task_dict dictionary into list of dictionaries. Each dictionary stores
+        information about the geometry of a single shot.
+        '''
+        return [(lambda d: d.update(id=key) or d)(val)
+                for (key, val) in self.tasks_dict.items()]
+
+    def create_break_list(self, shot_master_list=None):
         ''''
         Converts task_dict dictionary into list of dictionaries and breaks the list into
         sublists. Each dictionary stores information about the geometry of a single shot.
 
+        Args:
+            shot_master_list (list, optional): Shots to break up. Default all shots
+
         Returns:
             break_list (list): List with sublists (smaller lists) of dictionaries
         '''
-        shot_master_list = [(lambda d: d.update(id=key) or d)(val)
-                            for (key, val) in self.tasks_dict.items()]
+        if shot_master_list is None:
+            shot_master_list = self.create_shot_list()
         # Share work roughly evenly between processes. Original list of shots is break up
         # into many lists. In other words a list of lists will be divided up among the
         # processes. 
@@ -146,57 +726,150 @@ class DaskCluster:
         else:
             p = self.config_values["n_workers"]*self.config_values["processes"]
 
-        # Note that we assume that the number of shots is greater than the number
-        # of processes
-
+        # With fewer shots than processes, some processes get no shots
         c = len(shot_master_list)//p
         r = len(shot_master_list) % p
         # How many elements break_list should have
         break_list = [shot_master_list[i*(c+1):i*(c+1)+c+1] if i < r else
                       shot_master_list[i*c+r:i*c+r+c] for i in range(0, p)]
 
-        return break_list
+        return [b for b in break_list if b]
 
     def bcast_data(self):
         '''
-        Adds multiple devito Operators to config_values dictionary. A scatter operation
-        is used to move a new dictionary with unpacked items from config_values to all
-        workers (broadcast=True). It is useful as Operators are used in many computations
+        Resolves the gradient options that depend on the model and sends a light
+        specification of the solver and of the devito Operators to all workers
+        (broadcast=True). The workers build, compile and cache the devito objects
+        themselves (see SolverCache), so that they are reused across evaluations and
+        runs.
 
         Returns:
-            par (dask future): future pointing to dictionary with devito Operators
+            par (dask future): future pointing to the specification dictionary
         '''
         model = DaskCluster.get_model(self.config_values['solver_params'])
         t0 = self.config_values['solver_params']['t0']
         tn = self.config_values['solver_params']['tn']
         f0 = self.config_values['solver_params']['f0']
-        space_order = self.config_values['solver_params']['space_order']
         src_coordinates = np.empty((1, model.dim), dtype=np.float32)
         rec_coordinates = np.empty((self.config_values['nrecs'], model.dim),
                                    dtype=np.float32)
         geometry = AcquisitionGeometry(model, rec_coordinates, src_coordinates,
                                        t0=t0, tn=tn, src_type='Ricker', f0=f0)
-        solver = AcousticWaveSolver(model, geometry, space_order=space_order)
-
-        src_illum = Function(name='src_illum', grid=model.grid)
-        grad = Function(name='grad', grid=model.grid)
         dtype = self.config_values['solver_params']['dtype']
-        eps = np.finfo(dtype).eps
 
-        rev_op = DaskCluster.ImagingOperator(geometry, model, grad, src_illum,
-                                             space_order, save=True)
-        eq = Eq(src_illum, grad/(src_illum+eps))
-        pointwise_op = Operator(eq)
+        # In full mode the forward wavefield is saved and crosscorrelated every
+        # time_subsampling time steps only
+        if self.config_values['solver_params']['time_subsampling'] == 'auto':
+            self.config_values['solver_params']['time_subsampling'] = \
+                DaskCluster.subsampling_factor(f0, model.critical_dt)
+        factor = self.config_values['solver_params']['time_subsampling']
+
+        # The boundary, compressed and dft modes set the gradient to zero where the
+        # source illumination is negligible, as the error of their forward
+        # wavefield dominates there. With a data window the image of the
+        # illuminated region is weak and that region is a large part of the
+        # gradient, so that it is computed as in full mode
+        gradient_mode = self.config_values['solver_params']['gradient_mode']
+        if gradient_mode in ('boundary', 'compressed', 'dft') and \
+                self.config_values['solver_params']['window_velocity'] is not None:
+            print("The {} mode does not support data windows (window_velocity), "
+                  "switching to full".format(gradient_mode))
+            self.config_values['solver_params']['gradient_mode'] = 'full'
+
+        # In full mode the forward wavefield is spilled to scratch if it takes more
+        # than spill_fraction of the memory of a worker
+        gradient_mode = self.config_values['solver_params']['gradient_mode']
+        spill_fraction = self.config_values['solver_params']['spill_fraction']
+        if gradient_mode == 'full' and spill_fraction is not None:
+            if self.config_values["use_local_cluster"]:
+                memory_limit = parse_bytes(LOCAL_MEMORY_LIMIT)
+            else:
+                memory_limit = (parse_bytes(str(self.config_values["memory"]) + "GB") /
+                                self.config_values["processes"])
+            # A wavefield per shot of the batches propagated at once
+            nbytes = ((geometry.nt - 1) // factor + 1) * np.prod(model.grid.shape) * \
+                np.dtype(dtype).itemsize * \
+                self.config_values['solver_params']['propagation_batch']
+            if nbytes > spill_fraction * memory_limit:
+                print("Forward wavefield of {} does not fit in worker memory of {}, "
+                      "switching to out_of_core".format(humanbytes(nbytes),
+                                                        humanbytes(memory_limit)))
+                self.config_values['solver_params']['gradient_mode'] = 'out_of_core'
+
+        # The gradient of the dft mode is formed from running Fourier transforms of
+        # the forward and adjoint wavefields for a few frequencies
+        gradient_mode = self.config_values['solver_params']['gradient_mode']
+        if gradient_mode == 'dft' and \
+                self.config_values['solver_params']['dft_frequencies'] is None:
+            nfreq = self.config_values['solver_params']['dft_nfreq']
+            if nfreq is None:
+                # Frequency spacing such that the period of the time aliasing is 1.5
+                # times the record length
+                nfreq = int(np.ceil(1.5 * 3. * f0 * (tn - t0)))
+            self.config_values['solver_params']['dft_frequencies'] = \
+                np.linspace(3. * f0 / nfreq, 3. * f0, nfreq).tolist()
+
+        DaskCluster.print_wavefield_memory(model, geometry,
+                                           self.config_values['solver_params'])
 
-        self.config_values['solver_params']['rev_op'] = rev_op
-        self.config_values['solver_params']['pointwise_op'] = pointwise_op
-        self.config_values['solver_params']['solver'] = solver
         # send data to all workers
-        my_dict= {**self.config_values['solver_params']}
-        par = self.client.scatter(my_dict, broadcast=True)
+        return self.scatter_spec()
+
+    def solver_spec(self):
+        '''
+        Light specification from which the workers build the solver and the devito
+        Operators (see build_solver and build_operators)
+        '''
+        return {**self.config_values['solver_params'],
+                'nrecs': self.config_values['nrecs'],
+                'vmin': self.config_values['vmin']}
 
+    def scatter_spec(self):
+        '''
+        Sends the specification (see solver_spec) to all workers as a single object.
+        A scattered dictionary would use its keys as the keys of the data, so that a
+        later specification would not replace an earlier one
+
+        Returns:
+            par (dask future): future pointing to the specification dictionary
+        '''
+        [par] = self.client.scatter([self.solver_spec()], broadcast=True)
         return par
 
+    def report_memory(self):
+        '''
+        Prints the largest peak and steady-state resident memory of the workers
+        '''
+        stats = self.client.run(lambda dask_worker:
+                                dask_worker.plugins[BufferPool.name].memory_stats())
+        print("Worker RSS: peak {}, steady {} (max over {} workers)".format(
+            humanbytes(max(p for p, _ in stats.values())),
+            humanbytes(max(s for _, s in stats.values())), len(stats)))
+
+    def report_shot_cache(self):
+        '''
+        Prints the hit rate and memory use of the observed data caches of the workers
+        '''
+        stats = self.client.run(lambda dask_worker:
+                                dask_worker.plugins[ShotCache.name].stats())
+        hits = sum(h for h, _, _ in stats.values())
+        misses = sum(m for _, m, _ in stats.values())
+        print("Shot cache: hit rate {:.1f}% ({} hits, {} misses), {} on {} "
+              "workers".format(100. * hits / max(hits + misses, 1), hits, misses,
+                               humanbytes(sum(n for _, _, n in stats.values())),
+                               len(stats)))
+
+    def report_cache(self):
+        '''
+        Prints the hits and misses of the solver caches of all workers
+        '''
+        stats = self.client.run(lambda dask_worker:
+                                dask_worker.plugins[SolverCache.name].stats())
+        hits = sum(h for h, _ in stats.values())
+        misses = sum(m for _, m in stats.values())
+        print("Solver cache: {} hits, {} misses on {} workers".format(hits, misses,
+                                                                      len(stats)))
+
     def gen_shots_cluster(self):
         '''
         Forward modeling for all the shots in parallel in a dask cluster.
@@ -206,36 +879,88 @@ class DaskCluster:
 
         '''
         start_time = time.time()
-        model = DaskCluster.get_model(self.config_values['solver_params'])
-        t0 = self.config_values['solver_params']['t0']
-        tn = self.config_values['solver_params']['tn']
-        f0 = self.config_values['solver_params']['f0']
-        space_order = self.config_values['solver_params']['space_order']
-        src_coordinates = np.empty((1, model.dim), dtype=np.float32)
-        rec_coordinates = np.empty((self.config_values['nrecs'], model.dim),
-                                   dtype=np.float32)
-        geometry = AcquisitionGeometry(model, rec_coordinates, src_coordinates,
-                                       t0=t0, tn=tn, src_type='Ricker', f0=f0)
-        solver = AcousticWaveSolver(model, geometry, space_order=space_order)
-
-        self.config_values['solver_params']['solver'] = solver
-        par = self.client.scatter({**self.config_values['solver_params']},
-                                  broadcast=True)
-        break_list = self.create_break_list()
-        shot_futures = self.client.map(DaskCluster.gen_shot_in_worker,
-                                       break_list,
-                                       solver_params=par,
-                                       resources={'process': 1})
+        shot_output = self.config_values['solver_params']['shot_output']
+        if shot_output != 'per_shot':
+            index = self.create_shot_output()
+        par = self.scatter_spec()
+        task_list = self.create_task_list()
+        shot_futures = self.map_tasks(DaskCluster.gen_shot_in_worker, task_list,
+                                      solver_params=par)
         all_shot_results = self.client.gather(shot_futures)
+        # Waits for the shots written in the background by every worker, and raises
+        # the first error of their writes
+        self.client.run(lambda dask_worker:
+                        dask_worker.plugins[ShotWriter.name].flush())
         elapsed_time = time.time() - start_time
         time_format = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
 
         if all(all_shot_results):
+            if shot_output == 'segy':
+                # The lookup index is written now, so that the fwi phase does not
+                # read the trace headers
+                save_segy_index(DaskCluster.shot_output_file(
+                    self.config_values['solver_params']), index)
             print("Forward modeling took :- {}".format(time_format))
             print("Successfully generated {0:d} shots".format(len(self.tasks_dict)))
+            self.report_cache()
+            self.report_memory()
         else:
             raise Exception("Some error occurred. Please check logs")
 
+    def create_shot_output(self):
+        '''
+        Creates the multi-shot output of the forward modeling (shot_output 'segy' or
+        'hdf5') with room for all the shots, which the workers fill in place, and
+        records the position of every shot in it in the tasks.
+
+        Returns:
+            index (dict): lookup index of the SEG-Y output (see utils.segy_index),
+                None for the HDF5 output, whose geometry is written here
+        '''
+        solver_params = self.config_values['solver_params']
+        if solver_params['dt'] is None:
+            raise ValueError("shot_output {} requires dt".format(
+                solver_params['shot_output']))
+        nsamples = int((solver_params['tn'] - solver_params['t0']) /
+                       solver_params['dt'] + 1)
+
+        def xyz(coords):
+            # (X, Z) coordinates of 2D models as (X, Y, Z)
+            coords = np.atleast_2d(np.asarray(coords, dtype=np.float64))
+            if coords.shape[-1] == 2:
+                coords = np.insert(coords, 1, 0., axis=-1)
+            return coords
+
+        shots = list(self.tasks_dict.values())
+        sources = np.vstack([xyz(d['Source']) for d in shots])
+        receivers = [xyz(d['Receivers']) for d in shots]
+        counts = np.array([len(r) for r in receivers])
+        positions = np.cumsum(counts) - counts
+        filename = DaskCluster.shot_output_file(solver_params)
+        for i, d in enumerate(shots):
+            d['Output_Shot'] = i
+            d['Output_Position'] = int(positions[i]) \
+                if solver_params['shot_output'] == 'segy' else i
+
+        if solver_params['shot_output'] == 'hdf5':
+            create_hdf5_store(filename, [str(i + 1) for i in range(len(shots))],
+                              sources, receivers, nsamples, solver_params['dt'])
+            return None
+        segy_create(filename, counts.sum(), nsamples, solver_params['dt'],
+                    ensemble_traces=counts.max())
+        return segy_index(sources, np.vstack(receivers), counts)
+
+    def evaluation_params(self):
+        '''
+        Solver parameters of the evaluations of the objective function, which the
+        first evaluation broadcasts to the workers (see bcast_data), again after
+        gen_grad_cluster.counter is reset to 0 (e.g. for a new frequency band)
+        '''
+        DaskCluster.gen_grad_cluster.counter += 1
+        if DaskCluster.gen_grad_cluster.counter == 1:
+            DaskCluster.gen_grad_cluster.par = self.bcast_data()
+        return DaskCluster.gen_grad_cluster.par
+
     def gen_grad_cluster(self, X):
         '''
         Gradient computing for all the shots in parallel in a dask cluster
@@ -247,68 +972,323 @@ class DaskCluster:
             objective (float): objective function value
             grad (np.ndarray): gradient for all shots
         '''
-        DaskCluster.gen_grad_cluster.counter += 1
+        par = self.evaluation_params()
         shot_futures = []
-        shape = self.config_values['solver_params']['shape']
-        spacing = self.config_values['solver_params']['spacing']
-        if DaskCluster.gen_grad_cluster.counter == 1:
-            func = DaskCluster.grad_fwi_in_worker
-            par = self.bcast_data()
-            break_list = self.create_break_list()
-            if not hasattr(DaskCluster.gen_grad_cluster, "func"):
-                DaskCluster.gen_grad_cluster.func = func
-            if not hasattr(DaskCluster.gen_grad_cluster, "par"):
-                DaskCluster.gen_grad_cluster.par = par
-            if not hasattr(DaskCluster.gen_grad_cluster, "bl"):
-                DaskCluster.gen_grad_cluster.bl = break_list
 
-        model = DaskCluster.get_model(self.config_values['solver_params'])
-        nbl = self.config_values['solver_params']['nbl']
-        large_X = expand_array(np.reshape(X, shape), nbl)
-        model.update('vp', 1.0/np.sqrt(large_X))
-        pickle.dump({'model': model}, open('model0.p', "wb"))
+        vp = self.scatter_model(X)
+        task_list, scale = self.shot_batch_tasks()
 
         start_time = time.time()
-        shot_futures = self.client.map(DaskCluster.gen_grad_cluster.func,
-                                       DaskCluster.gen_grad_cluster.bl,
-                                       solver_params=DaskCluster.gen_grad_cluster.par,
-                                       resources={'process': 1})
-        all_shot_results = self.client.gather(shot_futures)
-
-        if len(shape) == 2:
-            domain_size = ((shape[0] - 1) * spacing[0], (shape[1] - 1) * spacing[1])
-        else:
-            domain_size = ((shape[0] - 1) * spacing[0], (shape[1] - 1) * spacing[1],
-                           (shape[2] - 1) * spacing[2])
-
-        grid = Grid(shape=shape, extent=domain_size)
-        f = Function(name='f', grid=grid)
-        grad = Function(name='g', grid=grid)
-        grad_update = Inc(grad, f)
-        op_grad = Operator([grad_update])
-
-        grad.data[:] = all_shot_results[0][0]
-        objective = all_shot_results[0][1]
-        i = 1
-
-        # Iterating using while loop
-        while i < len(all_shot_results):
-            f.data[:] = all_shot_results[i][0]
-            op_grad.apply()
-            objective += all_shot_results[i][1]
-            i += 1
+        with get_task_stream(self.client) as stream:
+            shot_futures = self.map_tasks(DaskCluster.grad_fwi_in_worker,
+                                          task_list,
+                                          solver_params=par,
+                                          vp=vp)
+            grad, objective = self.tree_reduce(shot_futures).result()
+        self.report_affinity(task_list, shot_futures, stream.data)
+        if scale != 1:
+            grad *= scale
+            objective *= scale
 
         mute_depth = self.config_values['mute_depth']
         if mute_depth is not None:
-            grad.data[:, 0:mute_depth] = 0.
+            grad[:, 0:mute_depth] = 0.
 
         elapsed_time = time.time() - start_time
         print("Cost_fcn eval took {0:8.2f} sec - Cost_fcn={1:10.3E}".format(elapsed_time,
                                                                             objective))
-        del op_grad
-        return objective, grad.data.flatten().astype(np.float32)
+        if DaskCluster.gen_grad_cluster.counter == 1:
+            self.report_cache()
+        self.report_memory()
+        self.report_shot_cache()
+        return objective, grad.flatten().astype(np.float32)
     gen_grad_cluster.counter = 0
 
+    def gen_misfit_cluster(self, X):
+        '''
+        Objective function value for all the shots in parallel in a dask cluster,
+        with forward simulations only (see gen_shot_in_worker_rol)
+
+        Args:
+            X (np.ndarray): Updated physical parameter (i.e., vp)
+
+        Returns:
+            objective (float): objective function value
+        '''
+        par = self.evaluation_params()
+        vp = self.scatter_model(X)
+        task_list, scale = self.shot_batch_tasks()
+
+        start_time = time.time()
+        with get_task_stream(self.client) as stream:
+            misfits = self.map_tasks(DaskCluster.gen_shot_in_worker_rol,
+                                     task_list,
+                                     solver_params=par,
+                                     vp=vp)
+            objective = scale * self.tree_reduce(misfits).result()
+        self.report_affinity(task_list, misfits, stream.data)
+
+        elapsed_time = time.time() - start_time
+        print("Cost_fcn eval took {0:8.2f} sec - Cost_fcn={1:10.3E}".format(elapsed_time,
+                                                                            objective))
+        if DaskCluster.gen_grad_cluster.counter == 1:
+            self.report_cache()
+        self.report_shot_cache()
+        return objective
+
+    def map_tasks(self, func, task_list, **kwargs):
+        '''
+        Submits a task per list of shots of task_list, with the resources of a process.
+        In the affinity scheduling every task is sent back to the worker that ran it
+        last (see report_affinity), where the observed data of its shots and the
+        devito objects are cached. The other workers may still take it when that
+        worker is busy (work stealing) or lost.
+
+        Args:
+            func (function): worker function
+            task_list (list): lists of shots (see create_task_list)
+            kwargs: keyword arguments of func
+
+        Returns:
+            futures (list): dask futures of the tasks
+        '''
+        if self.config_values['scheduling'] != 'affinity':
+            return self.client.map(func, task_list, resources={'process': 1}, **kwargs)
+        workers = self.client.scheduler_info()['workers']
+        futures = []
+        for shots in task_list:
+            worker = self.affinity.get(DaskCluster.task_key(shots))
+            restrictions = {}
+            if worker in workers:
+                restrictions = {'workers': [worker], 'allow_other_workers': True}
+            futures.append(self.client.submit(func, shots, resources={'process': 1},
+                                              **restrictions, **kwargs))
+        return futures
+
+    @staticmethod
+    def task_key(shots):
+        '''
+        Key of the affinity of a task: the IDs of its shots
+        '''
+        return tuple(str(d['id']) for d in shots)
+
+    def report_affinity(self, task_list, futures, stream):
+        '''
+        Records the worker that ran every task of map_tasks, and prints how many tasks
+        moved to another worker and the transfers of data between workers
+
+        Args:
+            task_list (list): lists of shots of the tasks
+            futures (list): dask futures of the tasks of map_tasks
+            stream (list): task stream records (see dask.distributed.get_task_stream)
+        '''
+        index = {f.key: DaskCluster.task_key(shots)
+                 for shots, f in zip(task_list, futures)}
+        moved = 0
+        transfers = []
+        for record in stream:
+            transfers += [ss['stop'] - ss['start'] for ss in record['startstops']
+                          if ss['action'] == 'transfer']
+            key = index.get(record['key'])
+            if key is None or record['status'] != 'OK':
+                continue
+            moved += self.affinity.get(key, record['worker']) != record['worker']
+            self.affinity[key] = record['worker']
+        if self.config_values['scheduling'] == 'affinity':
+            print("Shot affinity: {} of {} tasks moved to another worker, {} transfers "
+                  "between workers ({:.2f} s)".format(moved, len(futures),
+                                                      len(transfers), sum(transfers)))
+
+    def tree_reduce(self, futures, fanin=2):
+        '''
+        Sums the results of tasks (see add_results) on the workers, so that the
+        client receives a single result. Every fanin results are added by a task as
+        soon as they are complete, and the partial sums are added in turn, which
+        forms a tree of additions that follows the order of completion
+
+        Args:
+            futures (list): dask futures of the results
+            fanin (int, optional): Number of results added by a task. Default 2
+
+        Returns:
+            dask future: future pointing to the sum of the results
+
+        Raises:
+            ValueError: If there are no results to add, e.g. no shots
+        '''
+        if not futures:
+            raise ValueError("No results to add: the list of shots is empty")
+        # Number of results and partial sums still to be added
+        remaining = len(futures)
+        completed = []
+        pending = as_completed(futures)
+        for future in pending:
+            if remaining == 1:
+                return future
+            completed.append(future)
+            if len(completed) in (fanin, remaining):
+                pending.add(self.client.submit(DaskCluster.add_results, *completed))
+                remaining -= len(completed) - 1
+                completed = []
+
+    @staticmethod
+    def add_results(*results):
+        '''
+        Sum of results of the worker functions: gradients, objective function values
+        or (gradient, objective) tuples. The first array is copied, and the others
+        are added to it in place
+        '''
+        if isinstance(results[0], tuple):
+            return tuple(DaskCluster.add_results(*r) for r in zip(*results))
+        if not isinstance(results[0], np.ndarray):
+            return sum(results)
+        total = np.array(results[0])
+        for r in results[1:]:
+            total += r
+        return total
+
+    def scatter_model(self, X):
+        '''
+        Sends the velocity of the current model to all workers, where it is applied
+        to the model they hold (see update_model)
+
+        Args:
+            X (np.ndarray): Updated physical parameter (i.e., 1/vp**2)
+
+        Returns:
+            vp (dask future): future pointing to the velocity without absorbing layers
+        '''
+        shape = self.config_values['solver_params']['shape']
+        vp = 1.0/np.sqrt(np.reshape(X, shape))
+        # A key of its own for every call, as the release of an earlier future of
+        # the same model (e.g. value and gradient at the same point) would drop the
+        # data of a key derived from the content
+        return self.client.scatter(vp, broadcast=True, hash=False)
+
+    @staticmethod
+    def update_model(model, vp, dt=None):
+        '''
+        Applies the velocity of the current model to the model of the solver held by
+        the worker
+
+        Args:
+            model (examples.seismic.model.SeismicModel): model of the solver
+            vp (np.ndarray): Velocity without absorbing layers
+            dt (float, optional): Time step of the model in place of its critical
+                time step, e.g. the one of the full model for the subgrid of a shot
+                (see aperture). Default None
+
+        Returns:
+            model (examples.seismic.model.SeismicModel): current model
+        '''
+        model.update('vp', expand_array(vp, model.nbl))
+        model._dt = None if dt is None else model.dtype(dt)
+        return model
+
+    @staticmethod
+    def cached_objects(spec, operators=False):
+        '''
+        Gets the solver, and optionally the gradient Operators, for a specification
+        from the cache of the worker, building them on a miss
+
+        Args:
+            spec (dict): specification of the solver (see solver_spec)
+            operators (bool, optional): Whether or not the Operators of the gradient
+                are needed as well. Default False
+
+        Returns:
+            dict: dictionary with the solver and the Operators
+        '''
+        cache = worker_plugin(SolverCache)
+        objects = cache.get(SolverCache.solver_key(spec),
+                            lambda: DaskCluster.build_solver(spec))
+        if operators:
+            solver = objects['solver']
+            objects = {**objects, **cache.get(
+                SolverCache.operators_key(spec),
+                lambda: DaskCluster.build_operators(spec, solver.model,
+                                                    solver.geometry))}
+        return objects
+
+    @staticmethod
+    def build_solver(spec):
+        '''
+        Builds the model and the solver for a specification (see solver_spec)
+
+        Returns:
+            dict: dictionary with the solver
+        '''
+        model = DaskCluster.get_model(spec)
+        src_coordinates = np.empty((1, model.dim), dtype=np.float32)
+        rec_coordinates = np.empty((spec['nrecs'], model.dim), dtype=np.float32)
+        geometry = AcquisitionGeometry(model, rec_coordinates, src_coordinates,
+                                       t0=spec['t0'], tn=spec['tn'], src_type='Ricker',
+                                       f0=spec['f0'])
+        solver = AcousticWaveSolver(model, geometry, space_order=spec['space_order'])
+        return {'solver': solver}
+
+    @staticmethod
+    def build_operators(spec, model, geometry):
+        '''
+        Builds the devito Operators of the gradient mode of a specification (see
+        solver_spec) on the model and geometry of the solver
+
+        Returns:
+            dict: dictionary with the Operators (rev_op, pointwise_op and fwd_op)
+        '''
+        space_order = spec['space_order']
+        src_illum = Function(name='src_illum', grid=model.grid)
+        grad = Function(name='grad', grid=model.grid)
+        eps = np.finfo(spec['dtype']).eps
+
+        # With checkpointing the forward wavefield is kept in a 3-slot time buffer and
+        # recomputed from the checkpoints during the adjoint sweep. With boundary
+        # saving it is reconstructed backwards in time from the stored edge strips.
+        # With compression or out-of-core storage it is streamed in chunks through a
+        # circular time buffer
+        gradient_mode = spec['gradient_mode']
+        factor = spec['time_subsampling'] if gradient_mode == 'full' else 1
+        save = gradient_mode == 'full'
+        if gradient_mode in ('compressed', 'out_of_core'):
+            save = Buffer(spec['stream_chunk'] + 2)
+        ops = {}
+        if gradient_mode == 'dft':
+            nfreq = len(spec['dft_frequencies'])
+            ops['rev_op'] = DaskCluster.DFTImagingOperator(geometry, model, grad,
+                                                           space_order, nfreq)
+            ops['fwd_op'] = DaskCluster.ForwardOperator(geometry, model, space_order,
+                                                        src_illum=src_illum,
+                                                        nfreq=nfreq)
+        else:
+            ops['rev_op'] = DaskCluster.ImagingOperator(
+                geometry, model, grad, src_illum, space_order, save=save,
+                boundary=gradient_mode == 'boundary', factor=factor)
+        if factor > 1:
+            ops['fwd_op'] = DaskCluster.ForwardOperator(geometry, model, space_order,
+                                                        factor=factor)
+        elif gradient_mode == 'boundary':
+            ops['fwd_op'] = DaskCluster.ForwardOperator(geometry, model, space_order,
+                                                        src_illum=src_illum,
+                                                        boundary=True)
+        elif gradient_mode in ('compressed', 'out_of_core'):
+            ops['fwd_op'] = DaskCluster.ForwardOperator(geometry, model, space_order,
+                                                        save=save)
+        nbatch = spec['propagation_batch']
+        if gradient_mode == 'full' and nbatch > 1:
+            # Operators that propagate nbatch shots at once (see batched_gradient)
+            suffixes = DaskCluster.batch_suffixes(nbatch)
+            ops['batch_fwd_op'] = DaskCluster.ForwardOperator(
+                geometry, model, space_order, save=geometry.nt if factor == 1 else None,
+                factor=factor, nbatch=nbatch)
+            ops['batch_rev_op'] = DaskCluster.ImagingOperator(
+                geometry, model, [Function(name='grad' + i, grid=model.grid)
+                                  for i in suffixes],
+                [Function(name='src_illum' + i, grid=model.grid) for i in suffixes],
+                space_order, save=True, factor=factor, nbatch=nbatch)
+        eq = Eq(src_illum, grad/(src_illum+eps))
+        ops['pointwise_op'] = Operator(eq)
+        return ops
+
     @staticmethod
     def gen_shot_in_worker(shot_dict, solver_params):
         '''
@@ -330,7 +1310,10 @@ class DaskCluster:
         t0 = solver_params['t0']
         tn = solver_params['tn']
         model_name = solver_params['model_name']
-        solver = solver_params['solver']
+        # The cached solver may hold another velocity (e.g. from an inversion), so
+        # the true model is passed explicitly
+        solver = DaskCluster.cached_objects(solver_params)['solver']
+        solver.geometry.resample(model.critical_dt)
 
         # Geometry for current shot
         src = solver.geometry.src
@@ -340,46 +1323,151 @@ class DaskCluster:
         u = TimeFunction(name="u", grid=model.grid, time_order=2,
                          space_order=space_order)
         autotune = ('aggressive', 'runtime') if len(shape) == 3 else False
+        writer = worker_plugin(ShotWriter)
+        resample = dt is not None
+        if not resample:
+            dt = model.critical_dt
+        nsamples = int((tn-t0)/dt + 1)
+
+        # Shots cut short by adaptive_record_length (see shot_window) are zero
+        # after their last time step
+        spec = {**solver_params, 'window_velocity': None}
+
+        def write(d, src, dobs, nt):
+            if nt < solver.geometry.nt:
+                dobs.data[nt-1:] = 0.
+            print('Shot with time interval of {} ms'.format(model.critical_dt))
+            data = dobs.resample(num=nsamples) if resample else dobs
+            # The shot is copied out of the devito objects, which are reused by the
+            # next shot, and written in the background
+            writer.submit(DaskCluster.write_shot, solver_params, d,
+                          np.array(data.data), np.array(src.coordinates.data[0]),
+                          np.array(data.coordinates.data), dt)
 
         if not type(shot_dict) is list:
             shot_dict = [shot_dict]
 
-        for d in shot_dict:
+        # Shots propagated nbatch at a time (see ForwardOperator), the rest one by
+        # one. The shots of the aperture mode are propagated one by one on their own
+        # subgrid (see aperture)
+        margin = solver_params['aperture_margin']
+        nbatch = solver_params['propagation_batch'] if margin is None else 1
+        nbatched = len(shot_dict) - len(shot_dict) % nbatch if nbatch > 1 else 0
+        if nbatched:
+            fwd_op = worker_plugin(SolverCache).get(
+                ('forward', SolverCache.solver_key(solver_params), nbatch),
+                lambda: DaskCluster.ForwardOperator(solver.geometry, solver.model,
+                                                    space_order, nbatch=nbatch))
+            us = [TimeFunction(name='u' + i, grid=model.grid, time_order=2,
+                               space_order=space_order)
+                  for i in DaskCluster.batch_suffixes(nbatch)]
+        for k in range(0, nbatched, nbatch):
+            batch = shot_dict[k:k+nbatch]
+            nts = [DaskCluster.shot_window(d, model, solver.geometry, spec)[0]
+                   for d in batch]
+            args = {}
+            for i, d, u_i in zip(DaskCluster.batch_suffixes(nbatch), batch, us):
+                u_i.data[:] = 0.
+                args['src' + i] = solver.geometry.new_src(name='src' + i)
+                args['rec' + i] = solver.geometry.new_rec(name='rec' + i)
+                args['src' + i].coordinates.data[:] = np.array(d['Source']).reshape(
+                    (1, len(shape)))
+                args['rec' + i].coordinates.data[:] = np.array(d['Receivers'])
+                args['u' + i] = u_i
+            fwd_op(vp=model.vp, dt=model.critical_dt, time_M=max(nts)-2,
+                   autotune=autotune, **args)
+            for i, d, nt in zip(DaskCluster.batch_suffixes(nbatch), batch, nts):
+                write(d, args['src' + i], args['rec' + i], nt)
+
+        for d in shot_dict[nbatched:]:
+            nt = DaskCluster.shot_window(d, model, solver.geometry, spec)[0]
+            kwargs = {'time_M': nt-2} if nt < solver.geometry.nt else {}
+            if margin is not None:
+                box, shot = DaskCluster.aperture(d, model, margin)
+                sub = DaskCluster.cached_objects(
+                    {**solver_params, 'aperture_shape': [b.stop - b.start for b in box]})
+                sub_solver = sub['solver']
+                slices = tuple(slice(model.nbl, -model.nbl) for _ in range(model.dim))
+                sub_model = DaskCluster.update_model(
+                    sub_solver.model, model.vp.data[slices][box], model.critical_dt)
+                sub_solver.geometry.resample(model.critical_dt)
+                sub_src = sub_solver.geometry.src
+                sub_rec = sub_solver.geometry.rec
+                sub_src.coordinates.data[:], sub_rec.coordinates.data[:] = \
+                    DaskCluster.shot_coordinates(shot, model.dim)
+                sub_solver.forward(src=sub_src, rec=sub_rec, vp=sub_model.vp,
+                                   dt=model.critical_dt, autotune=autotune, **kwargs)
+                # The shot is written with the coordinates of the survey
+                sub_src.coordinates.data[:] = np.array(d['Source']).reshape(
+                    (1, len(shape)))
+                sub_rec.coordinates.data[:] = np.array(d['Receivers'])
+                write(d, sub_src, sub_rec, nt)
+                continue
             u.data[:] = 0.
             src.coordinates.data[:] = np.array(d['Source']).reshape((1, len(shape)))
             dobs.coordinates.data[:] = np.array(d['Receivers'])
-            solver.forward(src=src, rec=dobs, u=u, autotune=autotune)
+            solver.forward(src=src, rec=dobs, u=u, vp=model.vp, dt=model.critical_dt,
+                           autotune=autotune, **kwargs)
+            write(d, src, dobs, nt)
+        # The last shots are still being written when the task returns, so that they
+        # overlap with the next task of the worker; gen_shots_cluster waits for them
+        return True
 
-            print('Shot with time interval of {} ms'.format(model.critical_dt))
+    @staticmethod
+    def write_shot(solver_params, shot, data, src_coords, rec_coords, dt):
+        '''
+        Writes a shot of the forward modeling to its own SEG-Y file, or to the
+        multi-shot output created by DaskCluster.create_shot_output (shot_output)
 
-            str_shot = str(d['id']).zfill(3)
-            filename = '{}_{}_suheader_{}.segy'.format('shot', str_shot, model_name)
-            filename = solver_params['shotfile_path'] + filename
-            if dt is not None:
-                nsamples = int((tn-t0)/dt + 1)
-                data = dobs.resample(num=nsamples)
-            else:
-                dt = model.critical_dt
-                data = dobs
+        Args:
+            solver_params (dict): Dictionary containing diverse informations about
+                 adjoint simulation.
+            shot (dict): Dictionary containing informations about a single shot.
+            data (np.ndarray): Shot data of shape (nsamples, number of receivers)
+            src_coords (np.ndarray): Source coordinates
+            rec_coords (np.ndarray): Receiver coordinates
+            dt (float): Sample interval in ms
+        '''
+        shot_output = solver_params['shot_output']
+        if shot_output == 'hdf5':
+            hdf5_write_shot(DaskCluster.shot_output_file(solver_params),
+                            shot['Output_Shot'], data)
+            return
+
+        kwargs = {}
+        if len(src_coords) == 3:
+            kwargs = {'sourceY': [src_coords[1]], 'groupY': rec_coords[:, 1]}
+        if shot_output == 'segy':
+            traces = segy_traces(data, [src_coords[0]], [src_coords[-1]],
+                                 rec_coords[:, 0], rec_coords[:, -1], dt,
+                                 fldr=shot['Output_Shot'] + 1,
+                                 position=shot['Output_Position'], **kwargs)
+            segy_write_traces(DaskCluster.shot_output_file(solver_params),
+                              shot['Output_Position'], traces)
+        else:
             # Save shot in segy format
-            if len(shape) == 3:
-                segy_write(data.data[:], [src.coordinates.data[0, 0]],
-                           [src.coordinates.data[0, -1]],
-                           data.coordinates.data[:, 0],
-                           data.coordinates.data[:, -1], dt, filename,
-                           sourceY=[src.coordinates.data[0, 1]],
-                           groupY=data.coordinates.data[:, -1])
-            else:
-                segy_write(data.data[:], [src.coordinates.data[0, 0]],
-                           [src.coordinates.data[0, -1]],
-                           data.coordinates.data[:, 0],
-                           data.coordinates.data[:, -1], dt, filename)
-            data = None
-        del solver
-        return True
+            str_shot = str(shot['id']).zfill(3)
+            filename = '{}_{}_suheader_{}.segy'.format('shot', str_shot,
+                                                       solver_params['model_name'])
+            filename = solver_params['shotfile_path'] + filename
+            traces = segy_traces(data, [src_coords[0]], [src_coords[-1]],
+                                 rec_coords[:, 0], rec_coords[:, -1], dt, **kwargs)
+            segy_create(filename, len(traces), data.shape[0], dt)
+            segy_write_traces(filename, 0, traces)
 
     @staticmethod
-    def gen_shot_in_worker_rol(shot_dict, solver_params):
+    def shot_output_file(solver_params):
+        '''
+        Path of the multi-shot output of the forward modeling (see shot_output)
+        '''
+        if solver_params['shot_output'] == 'hdf5':
+            name = 'shots.h5'
+        else:
+            name = 'shots_suheader_{}.segy'.format(solver_params['model_name'])
+        return solver_params['shotfile_path'] + name
+
+    @staticmethod
+    def gen_shot_in_worker_rol(shot_dict, solver_params, vp):
         '''
         Serial Forward modeling function (ROL).
 
@@ -387,69 +1475,66 @@ class DaskCluster:
             shot_dict (dict): Dictionary containing informations about a single shot.
             solver_params (dict): Dictionary containing diverse informations about
                  adjoint simulation.
+            vp (np.ndarray): Velocity of the current model without absorbing layers
 
         Returns:
             objective (float): objective function value
         '''
+        if solver_params['aperture_margin'] is not None and \
+                solver_params.get('aperture_shape') is None:
+            return DaskCluster.aperture_results(DaskCluster.gen_shot_in_worker_rol,
+                                                shot_dict, solver_params, vp)
         space_order = solver_params['space_order']
         # Set up solver    
-        solver = solver_params['solver']
+        solver = DaskCluster.cached_objects(solver_params)['solver']
 
         # Get the current model
-        pkl = pickle.load(open('model0.p', "rb"))
-        model = pkl['model']
+        model = DaskCluster.update_model(solver.model, vp,
+                                         solver_params.get('aperture_dt'))
         solver.geometry.resample(model.critical_dt)
 
         # Geometry for current shot
-        src = solver.geometry.src
+        shot_src = DaskCluster.band_source(solver.geometry, solver_params)
         rec = solver.geometry.rec
         slices = tuple(slice(model.nbl, -model.nbl) for _ in range(model.dim))
 
-        # Here we assume that there is enough memory
-        residual = Receiver(name='residual', grid=model.grid,
-                            time_range=solver.geometry.time_axis,
-                            coordinates=rec.coordinates)
-        u = TimeFunction(name='u', grid=model.grid, time_order=2,
-                         space_order=space_order)
+        # Here we assume that there is enough memory. The buffers are reused across
+        # shots and evaluations while the time axis does not change
+        key = (model.grid.shape, solver.geometry.nt, space_order)
+        residual, u = worker_plugin(BufferPool).get(
+            'forward', key, lambda: (
+                Receiver(name='residual', grid=model.grid,
+                         time_range=solver.geometry.time_axis,
+                         npoint=solver.geometry.nrec),
+                TimeFunction(name='u', grid=model.grid, time_order=2,
+                             space_order=space_order)))
 
         # loop over the shots
         if not type(shot_dict) is list:
             shot_dict = [shot_dict]
         objective =0.
         for d in shot_dict:
-            # Get a single shot as a numpy array
-            retrieved_shot, tn, dt = load_shot(d['filename'],
-                                               d['Trace_Position'],
-                                               d['Num_Traces'])
-
-            if model.dim == 3:
-                src_coord = np.array(d['Source']).reshape((1, 3))
-                rec_coord = np.array(d['Receivers'])
-            else:
-                src_coord = np.array([d['Source'][0],
-                                      d['Source'][-1]]).reshape((1, 2))
-                rec_coord = np.array([(r[0], r[-1]) for r in d['Receivers']])
+            src_coord, rec_coord = DaskCluster.shot_coordinates(d, model.dim)
             u.data[:] = 0.
+            # Source and observed data resampled to the time axis of the solver
+            src, dobs = DaskCluster.shot_source(d, solver.geometry, shot_src,
+                                                solver_params['max_frequency'])
             src.coordinates.data[:] = src_coord
             residual.coordinates.data[:] = rec.coordinates.data[:] = rec_coord
-            time_range = TimeAxis(start=0, stop=tn, step=dt)
-            dobs = Receiver(name='dobs', grid=solver.model.grid, time_range=time_range,
-                            coordinates=rec_coord)
-            dobs.data[:] = retrieved_shot[:]
-            dobs = dobs.resample(num=solver.geometry.nt)
+            # Time steps and data window of the shot
+            nt, window = DaskCluster.shot_window(d, model, solver.geometry,
+                                                 solver_params)
+            kwargs = {'time_M': nt-2} if nt < solver.geometry.nt else {}
             solver.forward(src=src, rec=rec, u=u, vp=model.vp,
-                           dt=model.critical_dt, save=False)
+                           dt=model.critical_dt, save=False, **kwargs)
 
-            residual.data[:] = rec.data - dobs.data
-            objective += .5*np.linalg.norm(residual.data.ravel())**2
+            objective += DaskCluster.data_residual(residual, rec, dobs, nt, window)
             dobs = None
-        solver = None
-        gc.collect()
 
         return objective
 
     @staticmethod
-    def grad_fwi_in_worker(shot_dict, solver_params, return_tuple=True):
+    def grad_fwi_in_worker(shot_dict, solver_params, vp, return_tuple=True):
         '''
         Serial fwi gradient computation function
 
@@ -457,6 +1542,7 @@ class DaskCluster:
             shot_dict (dict): Dictionary containing informations about a single shot
             solver_params (dict): Dictionary containing diverse informations about
                  adjoint simulation
+            vp (np.ndarray): Velocity of the current model without absorbing layers
             return_tuple (bool): If True, return a tuple with additional information.
                 Default is True.
         Returns:
@@ -465,116 +1551,1093 @@ class DaskCluster:
             objective (float): objective function value
             copied_grad (np.ndarray): gradient for the given shot
         '''
+        if solver_params['aperture_margin'] is not None and \
+                solver_params.get('aperture_shape') is None:
+            grad, objective = DaskCluster.aperture_results(
+                DaskCluster.grad_fwi_in_worker, shot_dict, solver_params, vp)
+            return (grad, objective) if return_tuple else grad
         space_order = solver_params['space_order']
+        solver_params = {**solver_params,
+                         **DaskCluster.cached_objects(solver_params, operators=True)}
         solver = solver_params['solver']
         rev_op = solver_params['rev_op']
         pointwise_op = solver_params['pointwise_op']
 
         # Get the current model
-        pkl = pickle.load(open('model0.p', "rb"))
-        model = pkl['model']
+        model = DaskCluster.update_model(solver.model, vp,
+                                         solver_params.get('aperture_dt'))
         solver.geometry.resample(model.critical_dt)
 
         # Geometry for current shot
-        src = solver.geometry.src
+        shot_src = DaskCluster.band_source(solver.geometry, solver_params)
         rec = solver.geometry.rec
         objective = 0.
         slices = tuple(slice(model.nbl, -model.nbl) for _ in range(model.dim))
 
-        # Here we assume that there is enough memory
-        residual = Receiver(name='residual', grid=model.grid,
-                            time_range=solver.geometry.time_axis,
-                            coordinates=rec.coordinates)
-        src_illum = Function(name='src_illum', grid=model.grid)
-        grad = Function(name='grad', grid=model.grid)
-        gradsum = Function(name='gradsum', grid=model.grid)
-        du = TimeFunction(name='du', grid=model.grid, time_order=2,
-                          space_order=space_order)
-        u = TimeFunction(name='u', grid=model.grid, time_order=2,
-                         space_order=space_order, save=solver.geometry.nt)
+        # Here we assume that there is enough memory. The buffers are reused across
+        # shots and evaluations while the time axis does not change. The shots
+        # propagated at once (see batched_gradient) have a set of buffers each
+        nbatch = solver_params['propagation_batch'] if 'batch_fwd_op' in solver_params \
+            else 1
+        key = (model.grid.shape, solver.geometry.nt, space_order,
+               SolverCache.operators_key(solver_params))
+        batch_buffers = worker_plugin(BufferPool).get(
+            'gradient', key, lambda: [DaskCluster.gradient_buffers(
+                solver_params, model, solver.geometry) for _ in range(nbatch)])
+        buffers = batch_buffers[0]
+        residual, src_illum, grad, gradsum, du, u = (
+            buffers[k] for k in ('residual', 'src_illum', 'grad', 'gradsum', 'du', 'u'))
+        gradsum.data[:] = 0.
+        gradient_mode = solver_params['gradient_mode']
+        factor = solver_params['time_subsampling'] if gradient_mode == 'full' else 1
+        if factor > 1:
+            usave = buffers['usave']
+        elif gradient_mode == 'boundary':
+            strips = buffers['strips']
+        elif gradient_mode == 'dft':
+            freqs, weights, ufr, ufi = buffers['dft']
+        elif gradient_mode == 'compressed':
+            store = make_store(solver_params, solver.geometry.nt, model.grid.shape,
+                               model.dtype)
+            if solver_params['compression_check']:
+                ref_store = WavefieldStore(solver.geometry.nt, model.grid.shape,
+                                           model.dtype)
+        elif gradient_mode == 'out_of_core':
+            store = MemmapStore(solver.geometry.nt, model.grid.shape, model.dtype,
+                                scratch_path=solver_params['scratch_path'])
+
+        try:
+            # loop over the shots, nbatch at a time, then one by one. Only the shots
+            # with the same number of time steps (see shot_window) are propagated at
+            # once, as the source illumination of a shot would otherwise be summed
+            # beyond its record
+            if not type(shot_dict) is list:
+                shot_dict = [shot_dict]
+            batches = []
+            if nbatch > 1:
+                records = {}
+                for d in shot_dict:
+                    nt = DaskCluster.shot_window(d, model, solver.geometry,
+                                                 solver_params)[0]
+                    records.setdefault(nt, []).append(d)
+                shot_dict = []
+                for shots in records.values():
+                    nbatched = len(shots) - len(shots) % nbatch
+                    batches += [shots[k:k+nbatch] for k in range(0, nbatched, nbatch)]
+                    shot_dict += shots[nbatched:]
+            for batch in batches:
+                objective += DaskCluster.batched_gradient(
+                    solver_params, model, solver.geometry, batch_buffers, batch,
+                    factor)
+            for d in shot_dict:
+                src_coord, rec_coord = DaskCluster.shot_coordinates(d, model.dim)
+                u.data[:] = 0.
+                if factor > 1:
+                    usave.data[:] = 0.
+                du.data[:] = 0.
+                grad.data[:] = 0.
+                src_illum.data[:] = 0.
+                # Source and observed data resampled to the time axis of the solver
+                src, dobs = DaskCluster.shot_source(d, solver.geometry, shot_src,
+                                                    solver_params['max_frequency'])
+                src.coordinates.data[:] = src_coord
+                residual.coordinates.data[:] = rec.coordinates.data[:] = rec_coord
+                # Time steps and data window of the shot
+                nt, window = DaskCluster.shot_window(d, model, solver.geometry,
+                                                     solver_params)
+
+                if gradient_mode == 'checkpointing':
+                    objective += DaskCluster.checkpointed_gradient(
+                        solver, rev_op, model, u, du, grad, src_illum, src, rec, dobs,
+                        residual, solver_params['n_checkpoints'], nt, window)
+                elif gradient_mode == 'boundary':
+                    bnd = {f.name: f for f, _ in strips}
+                    for f in bnd.values():
+                        f.data[:] = 0.
+                    solver_params['fwd_op'](src=src, rec=rec, u=u, vp=model.vp,
+                                            dt=model.critical_dt, src_illum=src_illum,
+                                            time_M=nt-2, **bnd)
+
+                    objective += DaskCluster.data_residual(residual, rec, dobs, nt,
+                                                          window)
+
+                    # u holds the last two time steps, from which u0 is reconstructed
+                    rev_op(u0=u, du=du, vp=model.vp, dt=model.critical_dt,
+                           time_M=nt-2, grad=grad, rec=residual, src=src,
+                           **bnd)
+
+                    # The round-off error of the time reversal dominates the image
+                    # where the source illumination is negligible
+                    dark = src_illum.data < ILLUM_CUTOFF * src_illum.data.max()
+                elif gradient_mode == 'compressed':
+                    if solver_params['compression_check']:
+                        # Gradient of the same shot from the uncompressed wavefield
+                        DaskCluster.streamed_gradient(
+                            solver_params['fwd_op'], rev_op, model, ref_store, u, du,
+                            grad, src_illum, src, rec, dobs, residual, nt, window)
+                        dark = src_illum.data < ILLUM_CUTOFF * src_illum.data.max()
+                        pointwise_op.apply(grad=grad, src_illum=src_illum)
+                        src_illum.data[dark] = 0.
+                        ref_grad = src_illum.data.copy()
+                        du.data[:] = 0.
+                        grad.data[:] = 0.
+                        src_illum.data[:] = 0.
+
+                    objective += DaskCluster.streamed_gradient(
+                        solver_params['fwd_op'], rev_op, model, store, u, du, grad,
+                        src_illum, src, rec, dobs, residual, nt, window)
+                    print("Compression ratio of the forward wavefield: {:.2f} "
+                          "({})".format(store.compression_ratio,
+                                        humanbytes(store.nbytes)))
+
+                    # As for boundary saving, the compression error dominates where
+                    # the source illumination is negligible
+                    dark = src_illum.data < ILLUM_CUTOFF * src_illum.data.max()
+                elif gradient_mode == 'out_of_core':
+                    objective += DaskCluster.streamed_gradient(
+                        solver_params['fwd_op'], rev_op, model, store, u, du, grad,
+                        src_illum, src, rec, dobs, residual, nt, window)
+                elif gradient_mode == 'dft':
+                    ufr.data[:] = 0.
+                    ufi.data[:] = 0.
+                    solver_params['fwd_op'](src=src, rec=rec, u=u, vp=model.vp,
+                                            dt=model.critical_dt, src_illum=src_illum,
+                                            time_M=nt-2, freqs=freqs,
+                                            ufr=ufr, ufi=ufi)
+
+                    objective += DaskCluster.data_residual(residual, rec, dobs, nt,
+                                                          window)
+
+                    rev_op(du=du, vp=model.vp, dt=model.critical_dt,
+                           time_M=nt-2, grad=grad, rec=residual,
+                           freqs=freqs, weights=weights, ufr=ufr, ufi=ufi)
+
+                    # The time aliasing of the sparse frequency sampling dominates the
+                    # image where the source illumination is negligible
+                    dark = src_illum.data < ILLUM_CUTOFF * src_illum.data.max()
+                elif factor > 1:
+                    solver_params['fwd_op'](src=src, rec=rec, u=u, usave=usave,
+                                            vp=model.vp, dt=model.critical_dt,
+                                            time_M=nt-2)
+
+                    objective += DaskCluster.data_residual(residual, rec, dobs, nt,
+                                                          window)
+
+                    rev_op(u0=usave, du=du, vp=model.vp, dt=model.critical_dt,
+                           time_M=nt-2, grad=grad, src_illum=src_illum,
+                           rec=residual)
+                else:
+                    solver.forward(src=src, rec=rec, u=u, vp=model.vp,
+                                   dt=model.critical_dt, save=True, time_M=nt-2)
+
+                    objective += DaskCluster.data_residual(residual, rec, dobs, nt,
+                                                          window)
+
+                    rev_op(u0=u, du=du, vp=model.vp, dt=model.critical_dt,
+                           time_size=solver.geometry.nt, time_M=nt-2,
+                           grad=grad, src_illum=src_illum, rec=residual)
+
+                pointwise_op.apply(grad=grad, src_illum=src_illum)
+                if gradient_mode in ('boundary', 'compressed', 'dft'):
+                    src_illum.data[dark] = 0.
+                if gradient_mode == 'compressed' and \
+                        solver_params['compression_check']:
+                    print("Relative gradient error due to compression: {:.3e}".format(
+                        np.linalg.norm(src_illum.data - ref_grad) /
+                        np.linalg.norm(ref_grad)))
+                gradsum.data[:] += src_illum.data[:]
+                dobs = None
+        finally:
+            # The wavefield store, and the scratch file of the out-of-core mode, are
+            # released even if an Operator raises
+            if gradient_mode in ('compressed', 'out_of_core'):
+                store.close()
+
+        if gradient_mode == 'out_of_core':
+            print("Out-of-core I/O of the forward wavefield: write {}/s, read "
+                  "{}/s".format(humanbytes(store.write_bandwidth),
+                                humanbytes(store.read_bandwidth)))
+        copied_grad = gradsum.data[slices].copy()
+        if return_tuple:
+            return copied_grad, objective
+        else:
+            return copied_grad
+        return 
 
-        # loop over the shots
+    @staticmethod
+    def aperture(shot, model, margin):
+        '''
+        Subgrid of the model around the sources and receivers of a shot, widened by
+        margin metres on both sides in the horizontal directions and covering the
+        whole depth. Near the edges of the model the subgrid is shifted inside the
+        model rather than cut, so that the shots with the same extent share the same
+        subgrid shape, and thus the same solver and Operators.
+
+        Args:
+            shot (dict): Dictionary containing informations about a single shot or
+                supershot
+            model (examples.seismic.model.SeismicModel): full model
+            margin (float): Margin around the sources and receivers in metres
+
+        Returns:
+            box (tuple): slices of the subgrid in the full model without absorbing
+                layers
+            shot (dict): the shot with its coordinates relative to the subgrid, whose
+                origin is the one of the full model
+        '''
+        src_coord, rec_coord = DaskCluster.shot_coordinates(shot, model.dim)
+        coords = np.vstack([src_coord, rec_coord])
+        box = []
+        for i, (n, h, o) in enumerate(zip(model.shape, model.spacing, model.origin)):
+            if i == model.dim - 1:
+                box.append(slice(0, n))
+                continue
+            lo = int(np.floor((coords[:, i].min() - margin - o) / h))
+            hi = int(np.ceil((coords[:, i].max() + margin - o) / h)) + 1
+            width = min(hi - lo, n)
+            lo = min(max(lo, 0), n - width)
+            box.append(slice(lo, lo + width))
+        shift = np.array([b.start * h for b, h in zip(box, model.spacing)])
+        return tuple(box), {**shot, 'Source': src_coord - shift,
+                            'Receivers': rec_coord - shift}
+
+    @staticmethod
+    def aperture_results(func, shot_dict, solver_params, vp):
+        '''
+        Runs a worker function (grad_fwi_in_worker or gen_shot_in_worker_rol) for
+        every shot on its own subgrid (see aperture), with the time step of the full
+        model, and adds up the results. The gradient of every shot is added to the
+        gradient of the full model within the subgrid.
+
+        Args:
+            func (function): worker function
+            shot_dict (dict): Dictionary containing informations about a single shot
+            solver_params (dict): Dictionary containing diverse informations about
+                 adjoint simulation
+            vp (np.ndarray): Velocity of the current model without absorbing layers
+
+        Returns:
+            The objective function value, or a tuple containing the gradient and the
+            objective function value
+        '''
+        solver = DaskCluster.cached_objects(solver_params)['solver']
+        model = DaskCluster.update_model(solver.model, vp)
         if not type(shot_dict) is list:
             shot_dict = [shot_dict]
+        grad = None
+        objective = 0.
         for d in shot_dict:
-            # Get a single shot as a numpy array
-            retrieved_shot, tn, dt = load_shot(d['filename'],
-                                               d['Trace_Position'],
-                                               d['Num_Traces'])
-
-            if model.dim == 3:
-                src_coord = np.array(d['Source']).reshape((1, 3))
-                rec_coord = np.array(d['Receivers'])
-            else:
-                src_coord = np.array([d['Source'][0],
-                                     d['Source'][-1]]).reshape((1, 2))
-                rec_coord = np.array([(r[0], r[-1]) for r in d['Receivers']])
-            u.data[:] = 0.
-            du.data[:] = 0.
-            grad.data[:] = 0.
-            src_illum.data[:] = 0.
+            box, shot = DaskCluster.aperture(d, model, solver_params['aperture_margin'])
+            spec = {**solver_params, 'aperture_shape': [b.stop - b.start for b in box],
+                    'aperture_dt': float(model.critical_dt)}
+            result = func([shot], spec, np.ascontiguousarray(vp[box]))
+            if isinstance(result, tuple):
+                if grad is None:
+                    grad = np.zeros(model.shape, dtype=result[0].dtype)
+                grad[box] += result[0]
+                result = result[1]
+            objective += result
+        return objective if grad is None else (grad, objective)
+
+    @staticmethod
+    def batched_gradient(solver_params, model, geometry, buffers, shots, factor):
+        '''
+        Forward + adjoint simulation of a batch of shots in the full gradient mode
+        with the Operators that propagate them at once (see ForwardOperator and
+        ImagingOperator). As in the loop over the shots of grad_fwi_in_worker, the
+        gradient of every shot is normalized by its own source illumination, and it
+        is added to the gradsum buffer of the first shot. The shots have the same
+        number of time steps (see shot_window).
+
+        Args:
+            solver_params (dict): specification of the solver with its Operators
+            model (examples.seismic.model.SeismicModel): current model
+            geometry (examples.seismic.utils.AcquisitionGeometry): geometry resampled
+                to the time step of the current model
+            buffers (list): buffers of every shot of the batch (see
+                gradient_buffers)
+            shots (list): shots of the batch
+            factor (int): time subsampling factor of the forward wavefield
+
+        Returns:
+            objective (float): objective function value for the shots
+        '''
+        fwd_args, rev_args, recs, dobs, windows = {}, {}, [], [], []
+        if factor == 1:
+            fwd_args['time_size'] = rev_args['time_size'] = geometry.nt
+        for i, d, b in zip(DaskCluster.batch_suffixes(len(shots)), shots, buffers):
+            src_coord, rec_coord = DaskCluster.shot_coordinates(d, model.dim)
+            for f in ('u', 'usave', 'du', 'grad', 'src_illum'):
+                if f in b:
+                    b[f].data[:] = 0.
+            src, data = DaskCluster.shot_source(
+                d, geometry, DaskCluster.band_source(geometry, solver_params,
+                                                     name='src' + i),
+                solver_params['max_frequency'])
+            rec = geometry.new_rec(name='rec' + i)
             src.coordinates.data[:] = src_coord
-            residual.coordinates.data[:] = rec.coordinates.data[:] = rec_coord
+            b['residual'].coordinates.data[:] = rec.coordinates.data[:] = rec_coord
+            fwd_args.update({'src' + i: src, 'rec' + i: rec, 'u' + i: b['u']})
+            if factor > 1:
+                fwd_args['usave' + i] = b['usave']
+            rev_args.update({'u0' + i: b['usave'] if factor > 1 else b['u'],
+                             'du' + i: b['du'], 'grad' + i: b['grad'],
+                             'src_illum' + i: b['src_illum'], 'rec' + i: b['residual']})
+            recs.append(rec)
+            dobs.append(data)
+            windows.append(DaskCluster.shot_window(d, model, geometry, solver_params))
+
+        # The time loop stops at the last time step of the shots
+        nt = windows[0][0]
+        solver_params['batch_fwd_op'](vp=model.vp, dt=model.critical_dt, time_M=nt-2,
+                                      **fwd_args)
+        objective = 0.
+        for rec, data, (n, window), b in zip(recs, dobs, windows, buffers):
+            objective += DaskCluster.data_residual(b['residual'], rec, data, n, window)
+        solver_params['batch_rev_op'](vp=model.vp, dt=model.critical_dt, time_M=nt-2,
+                                      **rev_args)
+
+        for b in buffers[:len(shots)]:
+            solver_params['pointwise_op'].apply(grad=b['grad'],
+                                                src_illum=b['src_illum'])
+            buffers[0]['gradsum'].data[:] += b['src_illum'].data[:]
+        return objective
+
+    @staticmethod
+    def shot_coordinates(shot, dim):
+        '''
+        Source and receiver coordinates of a shot, or of a supershot (see
+        DaskCluster.encode_shots), in the dimensions of the model
+
+        Returns:
+            src_coord (np.ndarray): array of shape (number of sources, dim)
+            rec_coord (np.ndarray): array of shape (number of receivers, dim)
+        '''
+        src_coord = np.atleast_2d(np.asarray(shot['Source']))
+        rec_coord = np.asarray(shot['Receivers'])
+        if dim == 2:
+            # (X, Z) of the (X, Y, Z) coordinates of the SEG-Y headers
+            src_coord = src_coord[:, [0, -1]]
+            rec_coord = rec_coord[:, [0, -1]]
+        return src_coord, rec_coord
+
+    @staticmethod
+    def shot_source(shot, geometry, src, max_frequency=None):
+        '''
+        Source and observed data of a shot. The source of a supershot (see
+        DaskCluster.encode_shots) has a point per shot, which fires the wavelet of
+        src with the polarity and delay of the shot, and its observed data are the
+        sum of the observed data of the shots, encoded the same way
+
+        Args:
+            shot (dict): Dictionary containing informations about a single shot or
+                supershot
+            geometry (examples.seismic.utils.AcquisitionGeometry): geometry resampled
+                to the time step of the current model
+            src (examples.seismic.RickerSource): source of a single shot
+            max_frequency (float, optional): Cutoff frequency (kHz) of the low-pass
+                filter of the observed data (see lowpass). Default None, i.e., no
+                filter
+
+        Returns:
+            src (examples.seismic.PointSource): source of the shot
+            dobs (np.ndarray): observed data of shape (nt, number of traces)
+        '''
+        if 'Shots' not in shot:
+            return src, DaskCluster.observed_data(shot, geometry, max_frequency)
+        nt = geometry.nt
+        encoded = PointSource(name='src', grid=geometry.grid,
+                              time_range=geometry.time_axis, npoint=len(shot['Shots']))
+        dobs = np.zeros((nt, geometry.nrec), dtype=np.float32)
+        delays = np.minimum(np.rint(np.asarray(shot['Delay']) / geometry.dt), nt - 1)
+        for i, (d, polarity, n) in enumerate(zip(shot['Shots'], shot['Polarity'],
+                                                 delays.astype(int))):
+            # The Operators inject the source from the second time step on, so the
+            # first sample of the wavelet is left out of the delayed copy as well
+            encoded.data[n+1:, i] = polarity * src.data[1:nt-n, 0]
+            dobs[n:] += polarity * \
+                DaskCluster.observed_data(d, geometry, max_frequency)[:nt-n]
+        # The Operators do not compute the last time step, which the delayed copies
+        # would otherwise fill
+        dobs[-1] = 0.
+        return encoded, dobs
+
+    @staticmethod
+    def shot_window(shot, model, geometry, solver_params):
+        '''
+        Number of time steps of a shot and weights of its data window. With
+        adaptive_record_length the time loop stops when the reflection from the
+        bottom of the model at the lower bound of the velocity (vmin) has reached
+        the farthest receiver, plus the length of the wavelet (2/f0), so that the
+        record of a shot is the same for all the models of the inversion. With
+        window_velocity and window_length the samples later than offset /
+        window_velocity + window_length are left out of the misfit (e.g. to keep the
+        early arrivals only), and the time loop stops after the last sample of the
+        window. The times of the shots of a supershot are shifted by their delays.
+
+        Args:
+            shot (dict): Dictionary containing informations about a single shot or
+                supershot
+            model (examples.seismic.model.SeismicModel): current model
+            geometry (examples.seismic.utils.AcquisitionGeometry): geometry resampled
+                to the time step of the current model
+            solver_params (dict): Dictionary containing diverse informations about
+                 adjoint simulation
+
+        Returns:
+            nt (int): number of time steps of the shot
+            window (np.ndarray): weights (0 or 1) of the samples of shape (nt,
+                number of receivers), None without data window
+        '''
+        window_velocity = solver_params['window_velocity']
+        if not solver_params['adaptive_record_length'] and window_velocity is None:
+            return geometry.nt, None
+        src_coord, rec_coord = DaskCluster.shot_coordinates(shot, model.dim)
+        delays = np.asarray(shot.get('Delay', np.zeros(len(src_coord))))
+        # Horizontal offsets of the receivers from every source
+        offsets = np.sqrt(((rec_coord[None, :, :-1] -
+                            src_coord[:, None, :-1])**2).sum(axis=-1))
+        tmax = geometry.time_axis.stop
+        if solver_params['adaptive_record_length']:
+            depth = (model.shape[-1] - 1) * model.spacing[-1]
+            tmax = min(tmax, np.max(delays + np.sqrt(offsets.max(axis=1)**2 +
+                                                     (2. * depth)**2) /
+                                    solver_params['vmin']) +
+                       2. / solver_params['f0'])
+        if window_velocity is not None:
+            tend = np.max(delays[:, None] + offsets / window_velocity, axis=0) + \
+                solver_params['window_length']
+            tmax = min(tmax, tend.max())
+        # The time step nt-2 of the Operators computes the sample of time tmax
+        nt = min(geometry.nt, int(np.ceil((tmax - geometry.time_axis.start) /
+                                          geometry.dt)) + 2)
+        window = None
+        if window_velocity is not None:
+            time = geometry.time_axis.time_values[:nt]
+            window = (time[:, None] <= tend[None, :]).astype(np.float32)
+        return nt, window
+
+    @staticmethod
+    def data_residual(residual, rec, dobs, nt=None, window=None):
+        '''
+        Sets the data residual of a shot over its first nt time steps and within its
+        data window (see shot_window), and zero afterwards
+
+        Args:
+            residual (examples.seismic.Receiver): data residual
+            rec (examples.seismic.Receiver): modelled data
+            dobs (np.ndarray): observed data resampled to the time axis of rec
+            nt (int, optional): number of time steps of the shot. Default None, i.e.,
+                all the time steps of rec
+            window (np.ndarray, optional): weights of the data window. Default None
+
+        Returns:
+            objective (float): objective function value for the shot
+        '''
+        nt = nt or rec.data.shape[0]
+        residual.data[nt:] = 0.
+        residual.data[:nt] = rec.data[:nt] - dobs[:nt]
+        if window is not None:
+            residual.data[:nt] *= window
+        return .5*np.linalg.norm(residual.data.ravel())**2
+
+    @staticmethod
+    def lowpass(data, dt, max_frequency):
+        '''
+        Causal Butterworth low-pass filter of traces, e.g. for the frequency bands of
+        a multiscale inversion (see shot_control_inversion_multiscale.py). Applied
+        to the source and to the observed data alike, it keeps the modelled data of
+        the filtered source consistent with the filtered observed data. Unlike a
+        zero-phase filter, it also commutes with the end of the records at tn
+
+        Args:
+            data (np.ndarray): traces of shape (nt, number of traces)
+            dt (float): Time step (ms)
+            max_frequency (float): Cutoff frequency (kHz). None, or a frequency above
+                the Nyquist frequency, leaves the data unchanged
+
+        Returns:
+            np.ndarray: filtered float32 traces
+        '''
+        if max_frequency is None or max_frequency >= .5 / dt:
+            return data
+        sos = butter(LOWPASS_ORDER, max_frequency, fs=1. / dt, output='sos')
+        return sosfilt(sos, data, axis=0).astype(np.float32)
+
+    @staticmethod
+    def band_source(geometry, solver_params, name='src'):
+        '''
+        Source wavelet of the geometry, low-passed to max_frequency (see lowpass) and
+        scaled by source_scale. The point sources of devito inject their samples in
+        a single cell, so that their strength grows with the cell size, and on a
+        grid coarser than the one of the observed data (see get_model) the source
+        is scaled down by the ratio of the cell sizes
+
+        Args:
+            geometry (examples.seismic.utils.AcquisitionGeometry): geometry resampled
+                to the time step of the current model
+            solver_params (dict): Dictionary containing diverse informations about
+                 adjoint simulation
+            name (str, optional): name of the source. Default 'src'
+
+        Returns:
+            examples.seismic.PointSource: source of a single shot
+        '''
+        src = geometry.new_src(name=name)
+        src.data[:] = solver_params['source_scale'] * DaskCluster.lowpass(
+            src.data, geometry.dt, solver_params['max_frequency'])
+        return src
+
+    @staticmethod
+    def observed_data(shot, geometry, max_frequency=None):
+        '''
+        Observed data of a shot resampled to the time axis of the geometry, and
+        low-passed to max_frequency (see lowpass). The data are kept in the shot
+        cache of the worker (see ShotCache)
+
+        Args:
+            shot (dict): Dictionary containing informations about a single shot
+            geometry (examples.seismic.utils.AcquisitionGeometry): geometry resampled
+                to the time step of the current model
+            max_frequency (float, optional): Cutoff frequency (kHz) of the low-pass
+                filter. Default None, i.e., no filter
+
+        Returns:
+            np.ndarray: read-only float32 array of shape (nt, number of traces)
+        '''
+        key = (shot['filename'], shot['Trace_Position'], shot['Num_Traces'],
+               float(geometry.dt), geometry.nt, max_frequency)
+
+        def load():
+            retrieved_shot, tn, dt = load_shot(shot['filename'],
+                                               shot['Trace_Position'],
+                                               shot['Num_Traces'])
             time_range = TimeAxis(start=0, stop=tn, step=dt)
-            dobs = Receiver(name='dobs', grid=solver.model.grid, time_range=time_range,
-                            coordinates=rec_coord)
+            dobs = Receiver(name='dobs', grid=geometry.model.grid,
+                            time_range=time_range, npoint=shot['Num_Traces'])
             dobs.data[:] = retrieved_shot[:]
-            dobs = dobs.resample(num=solver.geometry.nt)
+            dobs = dobs.resample(num=geometry.nt)
+            data = np.array(dobs.data, dtype=np.float32)
+            if max_frequency is not None:
+                data = DaskCluster.lowpass(data, geometry.dt, max_frequency)
+                # The Operators do not compute the last time step, which is left
+                # out of the filtered data as well
+                data[-1] = 0.
+            return data
 
-            solver.forward(src=src, rec=rec, u=u, vp=model.vp,
-                           dt=model.critical_dt, save=True)
+        return worker_plugin(ShotCache).get(key, load)
 
-            residual.data[:] = rec.data - dobs.data
-            objective += .5*np.linalg.norm(residual.data.ravel())**2
+    @staticmethod
+    def gradient_buffers(spec, model, geometry):
+        '''
+        Allocates the devito Functions used by grad_fwi_in_worker for the gradient
+        mode of a specification (see solver_spec)
 
-            rev_op(u0=u, du=du, vp=model.vp, dt=model.critical_dt,
-                   time_size=solver.geometry.nt, time_M=solver.geometry.nt-2,
-                   grad=grad, src_illum=src_illum, rec=residual)
+        Args:
+            spec (dict): specification of the solver
+            model (examples.seismic.model.SeismicModel): model of the solver
+            geometry (examples.seismic.utils.AcquisitionGeometry): geometry resampled
+                to the time step of the current model
 
-            pointwise_op.apply(grad=grad, src_illum=src_illum)
-            gradsum.data[:] += src_illum.data[:]
-            dobs = None
+        Returns:
+            dict: dictionary with the Functions
+        '''
+        space_order = spec['space_order']
+        nt = geometry.nt
+        gradient_mode = spec['gradient_mode']
+        factor = spec['time_subsampling'] if gradient_mode == 'full' else 1
+        save = nt if gradient_mode == 'full' and factor == 1 else None
+        if gradient_mode in ('compressed', 'out_of_core'):
+            save = Buffer(spec['stream_chunk'] + 2)
+
+        buffers = {
+            'residual': Receiver(name='residual', grid=model.grid,
+                                 time_range=geometry.time_axis, npoint=geometry.nrec),
+            'src_illum': Function(name='src_illum', grid=model.grid),
+            'grad': Function(name='grad', grid=model.grid),
+            'gradsum': Function(name='gradsum', grid=model.grid),
+            'du': TimeFunction(name='du', grid=model.grid, time_order=2,
+                               space_order=space_order),
+            'u': TimeFunction(name='u', grid=model.grid, time_order=2,
+                              space_order=space_order, save=save)}
+        if factor > 1:
+            buffers['usave'] = DaskCluster.subsampled_wavefield('usave', model,
+                                                                space_order, nt, factor)
+        elif gradient_mode == 'boundary':
+            buffers['strips'] = DaskCluster.boundary_functions(model, space_order, nt)
+        elif gradient_mode == 'dft':
+            buffers['dft'] = DaskCluster.dft_functions(model, spec['dft_frequencies'])
+        return buffers
 
-        u = None
-        copied_grad = gradsum.data[slices].copy()
-        gc.collect()
-        if return_tuple:
-            return copied_grad, objective
+    @staticmethod
+    def checkpointed_gradient(solver, rev_op, model, u, du, grad, src_illum, src, rec,
+                              dobs, residual, n_checkpoints=None, nt=None, window=None):
+        '''
+        Forward + adjoint simulation of a single shot with optimal (Revolve)
+        checkpointing. Only n_checkpoints copies of the forward wavefield are kept in
+        memory, and the missing time steps are recomputed during the adjoint sweep.
+
+        Args:
+            solver (examples.seismic.acoustic.AcousticWaveSolver): solver of the shot
+            rev_op (devito.Operator): adjoint + crosscorrelation Operator built with
+                save=False
+            model (examples.seismic.model.SeismicModel): current model
+            u (devito.TimeFunction): forward wavefield without time saving
+            du (devito.TimeFunction): adjoint wavefield
+            grad (devito.Function): image accumulated by rev_op
+            src_illum (devito.Function): source illumination accumulated by rev_op
+            src (examples.seismic.RickerSource): source of the shot
+            rec (examples.seismic.Receiver): modelled data
+            dobs (np.ndarray): observed data resampled to the time axis of rec
+            residual (examples.seismic.Receiver): data residual
+            n_checkpoints (int, optional): number of checkpoints. If None, the
+                number is chosen by pyrevolve. Default None
+            nt (int, optional): number of time steps of the shot (see shot_window).
+                Default None, i.e., all the time steps of rec
+            window (np.ndarray, optional): weights of the data window of the shot.
+                Default None
+
+        Returns:
+            objective (float): objective function value for the shot
+        '''
+        cp = DevitoCheckpoint([u])
+        wrap_fw = CheckpointOperator(solver.op_fwd(save=False), src=src, rec=rec, u=u,
+                                     vp=model.vp, dt=model.critical_dt)
+        wrap_rev = CheckpointOperator(rev_op, u0=u, du=du, vp=model.vp,
+                                      dt=model.critical_dt, grad=grad,
+                                      src_illum=src_illum, rec=residual)
+        nt = nt or rec.data.shape[0]
+        wrp = Revolver(cp, wrap_fw, wrap_rev, n_checkpoints, nt-2)
+
+        wrp.apply_forward()
+        objective = DaskCluster.data_residual(residual, rec, dobs, nt, window)
+        wrp.apply_reverse()
+
+        return objective
+
+    @staticmethod
+    def streamed_gradient(fwd_op, rev_op, model, store, u, du, grad, src_illum, src,
+                          rec, dobs, residual, nt=None, window=None):
+        '''
+        Forward + adjoint simulation of a single shot with the forward wavefield kept
+        in a (possibly compressed) store. The wavefield is computed in chunks of time
+        steps within the circular buffer of u, from which every chunk is written to
+        the store, and it is read back chunk by chunk during the adjoint sweep.
+
+        Args:
+            fwd_op (devito.Operator): forward Operator built with the same buffer as u
+            rev_op (devito.Operator): adjoint + crosscorrelation Operator built with
+                the same buffer as u
+            model (examples.seismic.model.SeismicModel): current model
+            store (wavefield_storage.WavefieldStore): storage of the forward wavefield
+            u (devito.TimeFunction): forward wavefield with a Buffer(chunk+2) time
+                dimension
+            du (devito.TimeFunction): adjoint wavefield
+            grad (devito.Function): image accumulated by rev_op
+            src_illum (devito.Function): source illumination accumulated by rev_op
+            src (examples.seismic.RickerSource): source of the shot
+            rec (examples.seismic.Receiver): modelled data
+            dobs (np.ndarray): observed data resampled to the time axis of rec
+            residual (examples.seismic.Receiver): data residual
+            nt (int, optional): number of time steps of the shot (see shot_window).
+                Default None, i.e., all the time steps of rec
+            window (np.ndarray, optional): weights of the data window of the shot.
+                Default None
+
+        Returns:
+            objective (float): objective function value for the shot
+        '''
+        nt = nt or rec.data.shape[0]
+        size = u.data.shape[0]
+        chunk = size - 2
+
+        # Time step t of the operators computes time level t+1 from levels t and t-1,
+        # which live in u.data[t % size]. Levels 0 and 1 are zero
+        u.data[:] = 0.
+        store.write(0, u.data[:2])
+        for t0 in range(1, nt - 1, chunk):
+            t1 = min(t0 + chunk - 1, nt - 2)
+            fwd_op(src=src, rec=rec, u=u, vp=model.vp, dt=model.critical_dt,
+                   time_m=t0, time_M=t1)
+            levels = np.arange(t0 + 1, t1 + 2)
+            store.write(t0 + 1, u.data[levels % size])
+
+        objective = DaskCluster.data_residual(residual, rec, dobs, nt, window)
+
+        # Time step t of the adjoint sweep needs levels t-1, t and t+1
+        for t1 in range(nt - 2, 0, -chunk):
+            t0 = max(1, t1 - chunk + 1)
+            levels = np.arange(t0 - 1, t1 + 2)
+            block = np.empty((len(levels),) + store.shape, dtype=store.dtype)
+            store.read(t0 - 1, t1 + 2, block)
+            u.data[levels % size] = block
+            rev_op(u0=u, du=du, vp=model.vp, dt=model.critical_dt, time_m=t0,
+                   time_M=t1, grad=grad, src_illum=src_illum, rec=residual)
+
+        return objective
+
+    @staticmethod
+    def print_wavefield_memory(model, geometry, solver_params):
+        '''
+        Print the memory needed to hold the forward wavefield of one shot for the
+        selected gradient mode.
+        '''
+        dtype = np.dtype(solver_params['dtype'])
+        nbytes_step = np.prod(model.grid.shape) * dtype.itemsize
+        full = geometry.nt * nbytes_step
+        if solver_params['gradient_mode'] == 'checkpointing':
+            n_checkpoints = solver_params['n_checkpoints']
+            if n_checkpoints is None:
+                print("Checkpointing with automatic number of checkpoints "
+                      "(full wavefield is {})".format(humanbytes(full)))
+            else:
+                # Each checkpoint holds the 3 time slots of the wavefield buffer
+                print("Checkpointing with {} checkpoints: {} instead of {}".format(
+                    n_checkpoints, humanbytes(3 * (n_checkpoints + 1) * nbytes_step),
+                    humanbytes(full)))
+        elif solver_params['gradient_mode'] == 'boundary':
+            strips = DaskCluster.boundary_functions(model, solver_params['space_order'],
+                                                    geometry.nt)
+            nbytes = sum(np.prod(f.shape) for f, _ in strips) * dtype.itemsize
+            print("Boundary saving: {} instead of {}".format(humanbytes(nbytes),
+                                                           humanbytes(full)))
+        elif solver_params['gradient_mode'] == 'compressed':
+            if solver_params['compression'] == 'float16':
+                print("Float16 compression: {} instead of {}".format(
+                    humanbytes(full * 2 / dtype.itemsize), humanbytes(full)))
+            else:
+                # The size of the lossy store depends on the wavefield itself and
+                # is reported for every shot
+                print("Lossy compression with tolerance {} (full wavefield is "
+                      "{})".format(solver_params['compression_tol'], humanbytes(full)))
+        elif solver_params['gradient_mode'] == 'out_of_core':
+            print("Out-of-core wavefield: {} on scratch, {} in memory".format(
+                humanbytes(full), humanbytes((solver_params['stream_chunk'] + 2) *
+                                             nbytes_step)))
+        elif solver_params['gradient_mode'] == 'dft':
+            nfreq = len(solver_params['dft_frequencies'])
+            print("DFT with {} frequencies: {} instead of {}".format(
+                nfreq, humanbytes(2 * nfreq * nbytes_step), humanbytes(full)))
+        elif solver_params['time_subsampling'] > 1:
+            factor = solver_params['time_subsampling']
+            nbytes = ((geometry.nt - 1) // factor + 1) * nbytes_step
+            print("Time subsampling factor {}: {} instead of {}".format(
+                factor, humanbytes(nbytes), humanbytes(full)))
         else:
-            return copied_grad
-        return 
+            print("Forward wavefield per shot: {}".format(humanbytes(full)))
+        if solver_params['gradient_mode'] == 'full' and \
+                solver_params['propagation_batch'] > 1:
+            print("Shots propagated {} at a time, with a forward wavefield "
+                  "each".format(solver_params['propagation_batch']))
+
+    @staticmethod
+    def subsampling_factor(f0, dt):
+        '''
+        Time subsampling factor of the forward wavefield that samples the highest
+        frequency of the source twice as finely as the Nyquist criterion requires.
+        The spectrum of the Ricker wavelet is taken as negligible above 3*f0, where it
+        is not quite zero yet, hence the oversampling.
+
+        Args:
+            f0 (float): Peak frequency of the source (kHz)
+            dt (float): Modelling time step (ms)
+
+        Returns:
+            int: subsampling factor
+        '''
+        return max(1, int(1. / (OVERSAMPLING * 2. * 3. * f0 * dt)))
+
+    @staticmethod
+    def subsampled_wavefield(name, model, space_order, nt, factor):
+        '''
+        Creates a TimeFunction that holds a wavefield every factor time steps
+        '''
+        time_sub = ConditionalDimension(name='time_sub', parent=model.grid.time_dim,
+                                        factor=factor)
+        return TimeFunction(name=name, grid=model.grid, time_order=2,
+                            space_order=space_order, save=(nt - 1) // factor + 1,
+                            time_dim=time_sub)
+
+    @staticmethod
+    def dft_functions(model, frequencies):
+        '''
+        Creates the Functions of the frequency domain gradient: the frequencies, their
+        quadrature weights and the real and imaginary parts of the running Fourier
+        transform of the forward wavefield.
+
+        Args:
+            model (examples.seismic.model.SeismicModel): object that encapsules all
+                physical parameters
+            frequencies (list or int): Frequencies (kHz), or their number if only the
+                Functions are needed to build an Operator
+
+        Returns:
+            tuple: freqs, weights, ufr and ufi Functions
+        '''
+        nfreq = frequencies if isinstance(frequencies, int) else len(frequencies)
+        freq = DefaultDimension(name='freq', default_value=nfreq)
+        freqs = Function(name='freqs', dimensions=(freq,), shape=(nfreq,),
+                         dtype=model.dtype)
+        weights = Function(name='weights', dimensions=(freq,), shape=(nfreq,),
+                           dtype=model.dtype)
+        ufr, ufi = (Function(name=name, grid=model.grid,
+                             dimensions=(freq,) + model.grid.dimensions,
+                             shape=(nfreq,) + model.grid.shape, dtype=model.dtype)
+                    for name in ('ufr', 'ufi'))
+        if not isinstance(frequencies, int):
+            freqs.data[:] = frequencies
+            # Width of the frequency band represented by every frequency
+            weights.data[:] = np.gradient(frequencies) if nfreq > 1 else frequencies
+        return freqs, weights, ufr, ufi
+
+    @staticmethod
+    def boundary_functions(model, space_order, nt):
+        '''
+        Creates the Functions that store, for every time step, the strips of the
+        wavefield at the edges of the physical domain. There are two strips per
+        dimension and their width is half the space order, i.e., the radius of the
+        laplacian stencil.
+
+        Args:
+            model (examples.seismic.model.SeismicModel): object that encapsules all
+                physical parameters
+            space_order (int): Discretisation order for space derivatives
+            nt (int): Number of time steps
+
+        Returns:
+            list: List of tuples with each strip Function and the grid indices
+                (as expressions of the strip dimensions) it maps to
+        '''
+        time = model.grid.time_dim
+        width = space_order // 2
+        nbl = model.nbl
+        shape = tuple(n - 2*nbl for n in model.grid.shape)
+
+        strips = []
+        for i, d in enumerate(model.grid.dimensions):
+            for side in ('l', 'r'):
+                name = 'bnd_{}{}'.format(d.name, side)
+                dims = tuple(Dimension(name='{}_{}'.format(name, e.name))
+                             for e in model.grid.dimensions)
+                sizes = tuple(width if j == i else n for j, n in enumerate(shape))
+                offsets = [nbl] * model.dim
+                if side == 'r':
+                    offsets[i] = nbl + shape[i] - width
+                f = Function(name=name, dimensions=(time,) + dims, shape=(nt,) + sizes,
+                             dtype=model.dtype)
+                strips.append((f, tuple(o + k for o, k in zip(offsets, dims))))
+        return strips
+
+    @staticmethod
+    def ForwardOperator(geometry, model, space_order, save=None, src_illum=None,
+                        boundary=False, factor=1, nfreq=0, nbatch=1):
+        '''
+        Creates a forward Operator. Unlike the one of AcousticWaveSolver, the
+        wavefield may live in a circular time buffer of any size, and the Operator
+        can also accumulate the source illumination and store the wavefield at the
+        edges of the physical domain for every time step (see boundary_functions).
+        It may also propagate a batch of independent shots, every one with its own
+        wavefield, source and receivers (u<i>, src<i>, rec<i> and usave<i> for
+        i < nbatch), which are updated in the same loop over the grid, so that the
+        model parameters are read once per grid point for all the shots.
+
+        Args:
+            geometry (examples.seismic.utils.AcquisitionGeometry): object that encapsules
+                the geometry of an acquisition
+            model (examples.seismic.model.SeismicModel): object that encapsules all
+                physical parameters
+            space_order (int): Discretisation order for space derivatives
+            save (int or devito.Buffer, optional): Time size of the wavefield, or
+                circular buffer holding the last time steps. Default None, i.e.,
+                only the 3 time steps needed by the stencil are kept
+            src_illum (devito.types.Function, optional): Source illumination
+                function. It is accumulated from the forward wavefield if given.
+                Default None
+            boundary (bool, optional): Whether or not the edge strips of the
+                wavefield are stored. Default False
+            factor (int, optional): If larger than 1, the wavefield is also saved
+                every factor time steps into usave (see subsampled_wavefield).
+                Default 1
+            nfreq (int, optional): Number of frequencies of the running Fourier
+                transform of the wavefield accumulated into ufr and ufi (see
+                dft_functions). Default 0
+            nbatch (int, optional): Number of shots propagated at once. The
+                source illumination, edge strips and Fourier transforms are only
+                available for a single shot. Default 1
+
+        Returns:
+            devito.operator.operator.Operator: forward Operator
+        '''
+        if nbatch > 1 and (src_illum is not None or boundary or nfreq):
+            raise ValueError("Batched propagation only supports the full gradient mode")
+        dt = model.grid.stepping_dim.spacing
+        t = model.grid.stepping_dim
+
+        eqn, src_term, rec_term = [], [], []
+        for i in DaskCluster.batch_suffixes(nbatch):
+            src = PointSource(name='src' + i, grid=model.grid,
+                              time_range=geometry.time_axis, npoint=geometry.nsrc)
+            rec = Receiver(name='rec' + i, grid=model.grid,
+                           time_range=geometry.time_axis, npoint=geometry.nrec)
+            u = TimeFunction(name='u' + i, grid=model.grid, save=save, time_order=2,
+                             space_order=space_order)
+
+            eqn += iso_stencil(u, model, kernel='OT2')
+            src_term += [src.inject(field=u.forward, expr=src * dt**2 / model.m)]
+            rec_term += [rec.interpolate(expr=u)]
+
+            if src_illum is not None:
+                eqn += [Eq(src_illum, src_illum + u**2)]
+
+            if boundary:
+                strips = DaskCluster.boundary_functions(model, space_order, geometry.nt)
+                eqn += [Eq(f, u[(t,) + idx]) for f, idx in strips]
+
+            if factor > 1:
+                usave = DaskCluster.subsampled_wavefield('usave' + i, model, space_order,
+                                                         geometry.nt, factor)
+                eqn += [Eq(usave, u)]
+
+            if nfreq:
+                time = model.grid.time_dim
+                freqs, _, ufr, ufi = DaskCluster.dft_functions(model, nfreq)
+                phase = 2 * np.pi * freqs * time * dt
+                eqn += [Inc(ufr, u * cos(phase)), Inc(ufi, - u * sin(phase))]
+
+        return Operator(eqn + src_term + rec_term, name='Forward',
+                        subs=model.spacing_map)
+
+    @staticmethod
+    def batch_suffixes(nbatch):
+        '''
+        Suffixes of the names of the Functions of every shot of the Operators that
+        propagate nbatch shots at once (see ForwardOperator and ImagingOperator)
+        '''
+        return [''] if nbatch == 1 else [str(i) for i in range(nbatch)]
 
     def ImagingOperator(geometry, model, image, src_illum, space_order,
-                        save=True):
+                        save=True, boundary=False, factor=1, nbatch=1):
         '''
         Creates an adjoint + crosscorrelation Operator. It is used to
-        compute the gradient in the functions set out above.
+        compute the gradient in the functions set out above. Like ForwardOperator,
+        it may process a batch of shots at once (u0<i>, du<i> and rec<i>), with an
+        image and a source illumination per shot.
 
         Args:
             geometry (examples.seismic.utils.AcquisitionGeometry): object that encapsules
                 the geometry of an acquisition
             model (examples.seismic.model.SeismicModel): object that encapsules all
                 physical parameters
-            image (devito.types.Function): Image function
-            src_illum (devito.types.Function): Source illumination function
+            image (devito.types.Function or list): Image function, or list of
+                nbatch image functions
+            src_illum (devito.types.Function or list): Source illumination function,
+                or list of nbatch source illumination functions
             space_order (int): Discretisation order for space derivatives
-            save (bool, optional): Whether or not all forward states for all times
-                must be saved. Default True
+            save (bool or devito.Buffer, optional): Whether or not all forward
+                states for all times must be saved, or circular buffer holding the
+                forward states of a chunk of time steps. Default True
+            boundary (bool, optional): Whether or not the forward wavefield is
+                reconstructed backwards in time from the strips stored by
+                ForwardOperator. In that case u0 must hold the last two forward time
+                steps, save must be False and the source illumination is left to
+                ForwardOperator. Default False
+            factor (int, optional): Time subsampling factor of the saved forward
+                wavefield. If larger than 1, u0 holds the forward states every factor
+                time steps, the time derivative is moved to the adjoint wavefield and
+                the image is only updated at those time steps. Default 1
+            nbatch (int, optional): Number of shots processed at once, which
+                requires boundary to be False. Default 1
 
         Returns:
             devito.operator.operator.Operator: adjoint + crosscorrelation Operator
         '''
+        if nbatch > 1 and boundary:
+            raise ValueError("Batched propagation only supports the full gradient mode")
         dt = model.grid.stepping_dim.spacing
         time_order = 2
+        if isinstance(save, bool):
+            save = geometry.nt if save else None
+        images = image if nbatch > 1 else [image]
+        src_illums = src_illum if nbatch > 1 else [src_illum]
+
+        eqn, res_term, image_update, src_illum_updt = [], [], [], []
+        for i, image, src_illum in zip(DaskCluster.batch_suffixes(nbatch), images,
+                                       src_illums):
+            rec = Receiver(name='rec' + i, grid=model.grid,
+                           time_range=geometry.time_axis, npoint=geometry.nrec)
+
+            # Gradient symbol and wavefield symbols
+            if factor > 1:
+                u0 = DaskCluster.subsampled_wavefield('u0' + i, model, space_order,
+                                                      geometry.nt, factor)
+            else:
+                u0 = TimeFunction(name='u0' + i, grid=model.grid, save=save,
+                                  time_order=time_order, space_order=space_order)
+            du = TimeFunction(name='du' + i, grid=model.grid, save=None,
+                              time_order=time_order, space_order=space_order)
+
+            # Define the wave equation, but with a negated damping term
+            eqn += iso_stencil(du, model, kernel='OT2', forward=False)
+
+            # Define residual injection at the location of the forward receivers
+            res_term += [rec.inject(field=du.backward, expr=rec * dt**2 / model.m)]
+
+            if boundary:
+                eqn = DaskCluster._reconstruction_stencil(geometry, model, u0,
+                                                          space_order) + eqn
+
+            # Correlate u and v for the current time step and add it to the image
+            if factor > 1:
+                # Both sums are only sampled every factor time steps, hence the
+                # scaling
+                time_sub = u0.time_dim
+                image_update += [Inc(image, - factor * u0 * du.dt2,
+                                     implicit_dims=time_sub)]
+                src_illum_updt += [Eq(src_illum, src_illum + factor * u0**2,
+                                      implicit_dims=time_sub)]
+            else:
+                image_update += [Inc(image, - u0.dt2 * du)]
+                src_illum_updt += [] if boundary else [Eq(src_illum,
+                                                          src_illum + u0**2)]
+
+        return Operator(eqn + res_term + image_update +
+                        src_illum_updt, name='Gradient', subs=model.spacing_map)
+
+    @staticmethod
+    def DFTImagingOperator(geometry, model, image, space_order, nfreq):
+        '''
+        Creates an adjoint Operator that computes the gradient in the frequency
+        domain, from the Fourier transform of the forward wavefield accumulated by
+        ForwardOperator (see dft_functions). By Parseval's theorem, the
+        crosscorrelation of the imaging condition is
+
+            sum_t -u_tt * du = 2 * dt * sum_f weight_f * w_f**2 * Re(U_f * conj(DU_f))
+
+        where U_f and DU_f are the transforms of u and du. The product with the
+        transform of du is accumulated at every time step, so that DU_f does not need
+        to be stored. The source illumination is left to ForwardOperator.
+
+        Args:
+            geometry (examples.seismic.utils.AcquisitionGeometry): object that encapsules
+                the geometry of an acquisition
+            model (examples.seismic.model.SeismicModel): object that encapsules all
+                physical parameters
+            image (devito.types.Function): Image function
+            space_order (int): Discretisation order for space derivatives
+            nfreq (int): Number of frequencies
+
+        Returns:
+            devito.operator.operator.Operator: adjoint + frequency domain imaging
+                Operator
+        '''
+        dt = model.grid.stepping_dim.spacing
+        time = model.grid.time_dim
 
         rec = Receiver(name='rec', grid=model.grid, time_range=geometry.time_axis,
                        npoint=geometry.nrec)
-
-        # Gradient symbol and wavefield symbols
-        u0 = TimeFunction(name='u0', grid=model.grid, save=geometry.nt if save
-                          else None, time_order=time_order, space_order=space_order)
-        du = TimeFunction(name="du", grid=model.grid, save=None,
-                          time_order=time_order, space_order=space_order)
+        du = TimeFunction(name="du", grid=model.grid, save=None, time_order=2,
+                          space_order=space_order)
+        freqs, weights, ufr, ufi = DaskCluster.dft_functions(model, nfreq)
 
         # Define the wave equation, but with a negated damping term
         eqn = iso_stencil(du, model, kernel='OT2', forward=False)
@@ -582,12 +2645,47 @@ class DaskCluster:
         # Define residual injection at the location of the forward receivers
         res_term = rec.inject(field=du.backward, expr=rec * dt**2 / model.m)
 
-        # Correlate u and v for the current time step and add it to the image
-        image_update = Inc(image, - u0.dt2 * du)
-        src_illum_updt = Eq(src_illum, src_illum + u0**2)
+        # Re(U_f * exp(i*w_f*t)) correlated with du at time t adds up to
+        # Re(U_f * conj(DU_f))
+        omega = 2 * np.pi * freqs
+        phase = omega * time * dt
+        image_update = Inc(image, 2 * dt * weights * omega**2 *
+                           (ufr * cos(phase) - ufi * sin(phase)) * du)
+
+        return Operator(eqn + res_term + [image_update], name='GradientDFT',
+                        subs=model.spacing_map)
+
+    @staticmethod
+    def _reconstruction_stencil(geometry, model, u0, space_order):
+        '''
+        Equations that step the forward wavefield u0 backwards in time. The
+        undamped wave equation is reversed inside the physical domain, the source
+        is injected again and the edge strips are restored from storage.
+        '''
+        dt = model.grid.stepping_dim.spacing
+        t = model.grid.stepping_dim
+        time = model.grid.time_dim
+        width = space_order // 2
+
+        src = PointSource(name='src', grid=model.grid, time_range=geometry.time_axis,
+                          npoint=geometry.nsrc)
+
+        # Inner part of the physical domain, where the stencil does not reach into
+        # the absorbing layer
+        inner = {d: SubDimension.middle(name='{}_in'.format(d.name), parent=d,
+                                        thickness_left=model.nbl + width,
+                                        thickness_right=model.nbl + width)
+                 for d in model.grid.dimensions}
+        stencil = Eq(u0.backward, solve(model.m * u0.dt2 - u0.laplace, u0.backward))
+        stencil = stencil.evaluate.subs(inner)
+
+        src_term = src.inject(field=u0.backward, expr=src * dt**2 / model.m)
+
+        strips = DaskCluster.boundary_functions(model, space_order, geometry.nt)
+        restore = [Eq(u0[(t - 1,) + idx], f[(time - 1,) + f.dimensions[1:]])
+                   for f, idx in strips]
 
-        return Operator(eqn + res_term + [image_update] +
-                        [src_illum_updt], name='Gradient', subs=model.spacing_map)
+        return [stencil] + src_term + restore
 
     @staticmethod
     def get_model(par_dict):
@@ -613,6 +2711,17 @@ class DaskCluster:
             spacing = (*metadata['spacing'],)
             vp = np.empty(shape)
             f['vp'].read_direct(vp)
+        if par_dict.get('shape') is not None and tuple(par_dict['shape']) != shape:
+            # Coarser grid of a frequency band (see
+            # shot_control_inversion_multiscale.py), with the same extent
+            vp = resample_model(vp, par_dict['shape'])
+            shape = tuple(par_dict['shape'])
+            spacing = tuple(par_dict['spacing'])
+        if par_dict.get('aperture_shape') is not None:
+            # Subgrid of a shot (see DaskCluster.aperture), whose velocity is set by
+            # update_model
+            shape = tuple(par_dict['aperture_shape'])
+            vp = vp[tuple(slice(0, n) for n in shape)]
 
         space_order = par_dict['space_order']
         nbl = par_dict['nbl']
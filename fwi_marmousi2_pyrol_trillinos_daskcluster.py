@@ -8,73 +8,38 @@ from pyrol import getCout, Objective, Problem, Solver, Bounds
 from pyrol.pyrol.Teuchos import ParameterList
 from pyrol.vectors import NumPyVector
 
-from dask_cluster import DaskCluster
-import cloudpickle as pickle
-from utils import expand_array, save_model
+from dask_cluster import DaskCluster, MemoizedObjective
+from utils import save_model
 from inversion_script import inversion_setup
 
 
-def elementwise_sum(arrays):
-    """
-    Perform element-wise addition of NumPy arrays in a list.
-
-    Args:
-        arrays (list of np.ndarray): List of NumPy arrays to be summed.
-
-    Returns:
-        np.ndarray: Element-wise sum of the arrays.
-    """
-    # Perform element-wise addition using np.add.reduce
-    result = np.add.reduce(arrays, axis=0)
-    return result
-
 class Objective(Objective):
     def __init__(self, metadata):
         self.dc = DaskCluster()
         self.dc.config_values['solver_params']['origin'] = (*metadata['origin'],)
         self.dc.config_values['solver_params']['spacing'] = (*metadata['spacing'],)
         self.dc.config_values['solver_params']['shape'] = (*metadata['shape'],)
-        self.par = self.dc.bcast_data()
-        self.bl = self.dc.create_break_list()
+        # The value is evaluated with the gradient: most trial points of the
+        # quasi-Newton line search are accepted, and ROL asks for their gradient
+        # next, which is then not simulated again. With forward_value=True the
+        # rejected trial points cost a forward simulation only, but the accepted
+        # ones a forward simulation more
+        self.memo = MemoizedObjective(self.dc)
 
         super().__init__()
 
+    def update(self, x, type, iter=-1):
+        """Draw the next mini-batch of shots once an iterate is accepted"""
+        if type.name == 'Accept':
+            self.dc.new_shot_batch()
+
     def value(self, x, tol):
         """Compute the functional"""
-        model = DaskCluster.get_model(self.dc.config_values['solver_params'])
-        shape = self.dc.config_values['solver_params']['shape']
-        nbl = self.dc.config_values['solver_params']['nbl']
-        large_x = expand_array(np.reshape(x.array, shape), nbl)
-        model.update('vp', 1.0/np.sqrt(large_x))
-        with open('model0.p', 'wb') as file:
-            pickle.dump({'model': model}, file)
-        misfits = self.dc.client.map(DaskCluster.gen_shot_in_worker_rol,
-                                     self.bl,
-                                     solver_params=self.par,
-                                     resources={'process': 1})
-        total = self.dc.client.submit(sum, misfits)
-        return total.result()
+        return self.memo.value(x.array)
 
     def gradient(self, g, x, tol):
         """Compute the gradient of the functional"""
-        model = DaskCluster.get_model(self.dc.config_values['solver_params'])
-        shape = self.dc.config_values['solver_params']['shape']
-        nbl = self.dc.config_values['solver_params']['nbl']
-        large_x = expand_array(np.reshape(x.array, shape), nbl)
-        model.update('vp', 1.0/np.sqrt(large_x))
-        with open('model0.p', 'wb') as file:
-            pickle.dump({'model': model}, file)
-        gs = self.dc.client.map(DaskCluster.grad_fwi_in_worker,
-                                self.bl,
-                                solver_params=self.par,
-                                return_tuple=False,
-                                resources={'process': 1})
-        gradient = self.dc.client.submit(elementwise_sum, gs)
-        gsum = gradient.result()
-        mute_depth = self.dc.config_values['mute_depth']
-        if mute_depth is not None:
-            gsum[:, 0:mute_depth] = 0.
-        g[:] = gsum.flatten().astype(np.float32)
+        g[:] = self.memo.gradient(x.array)
         return 
 
 
@@ -131,6 +96,7 @@ def main():
     # Solve.  ###################################
     solver = Solver(problem, params)
     solver.solve(stream)
+    objective.memo.report()
     del objective.dc
 
     # Save FWI result
@@ -44,8 +44,8 @@ def forward_setup(yaml_file, model_name):
         nshots = data['nshots'] = cfg['nshots']
         model_size = data['model_size'] = cfg['model_size']
 
-        # solver parameters
-        data['solver_params'] = cfg['solver_params']
+        # solver parameters (options already set by the user are kept)
+        data['solver_params'] = {**data.get('solver_params', {}), **cfg['solver_params']}
 
     print("Solver parameters are being substituted with the following new values:")
     for key, value in data.get("solver_params").items():
@@ -26,8 +26,9 @@ def inversion_setup(yaml_file):
         data['vmin'] = 1.377
         data['vmax'] = 4.688
         data['mute_depth'] = 12
-        # solver parameters
-        data['solver_params'] = cfg['solver_params']
+        # solver parameters (options already set by the user, e.g. gradient_mode,
+        # are kept)
+        data['solver_params'] = {**data.get('solver_params', {}), **cfg['solver_params']}
         data['solver_params']['parfile_path'] = "./marmousi2/parameters_hdf5/"
         data['solver_params']['shotfile_path'] = "./marmousi2/shots/"
 
@@ -40,7 +41,8 @@ def main():
         'module', 
         choices=['shot_control_inversion_sotb',
                  'shot_control_inversion_nlopt',
-                 'shot_control_inversion_scipy'], 
+                 'shot_control_inversion_scipy',
+                 'shot_control_inversion_multiscale'], 
         help='The module to import the ControlInversion class from.'
     )
     args = parser.parse_args()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Ingest the per-shot SEG-Y files of a directory into a single HDF5 shot store.
+The traces are kept in a float32 dataset 'data' with shape (nshots, nsamples,
+max_traces), chunked one shot per chunk and uncompressed, so that a worker reads
+a whole gather with one call. The geometry of the shots is stored alongside, with
+the same shot IDs DaskCluster gives to the SEG-Y files.
+
+Usage:
+    python3 segy_to_hdf5.py ./marmousi2/shots/ [-o ./marmousi2/shots/shots.h5]
+'''
+
+import os
+import argparse
+
+from utils import make_tasks_table, load_shot, load_shots, create_hdf5_store
+from utils import hdf5_write_shot
+
+
+def segy_to_hdf5(segy_dir, h5_file):
+    '''
+    Writes the shots of the SEG-Y files of segy_dir into the shot store h5_file
+    '''
+    segy_files = [f for f in os.listdir(segy_dir) if f.endswith('.segy')]
+    segy_files = [os.path.join(segy_dir, sub) for sub in segy_files]
+    if not segy_files:
+        raise ValueError("No .segy files in {}".format(segy_dir))
+    tbl = make_tasks_table(segy_files)
+
+    shot_list = list(tbl.values())
+    nshots = len(shot_list)
+    max_traces = max(v['Num_Traces'] for v in shot_list)
+    data, _, dt = load_shot(shot_list[0]['filename'], shot_list[0]['Trace_Position'],
+                            shot_list[0]['Num_Traces'])
+    nsamples = data.shape[0]
+
+    create_hdf5_store(h5_file, list(tbl), [v['Source'] for v in shot_list],
+                      [v['Receivers'] for v in shot_list], nsamples, dt)
+    for sfile in segy_files:
+        # Shots of the file, read with one open file handle
+        index = [i for i, v in enumerate(shot_list) if v['filename'] == sfile]
+        shots = [shot_list[i] for i in index]
+        loaded = load_shots(sfile, [(v['Trace_Position'], v['Num_Traces'])
+                                    for v in shots])
+        for i, (data, _, samp_int) in zip(index, loaded):
+            if data.shape[0] != nsamples or samp_int != dt:
+                raise ValueError("Shot in {} has {} samples of {} ms, expected {} "
+                                 "of {} ms".format(sfile, data.shape[0],
+                                                   samp_int, nsamples, dt))
+            hdf5_write_shot(h5_file, i, data)
+
+    print("Wrote {} shots ({} samples, up to {} traces) to {}".format(
+        nshots, nsamples, max_traces, h5_file))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Ingest per-shot SEG-Y files into an HDF5 shot store')
+    parser.add_argument('segy_dir', help='directory of the SEG-Y files')
+    parser.add_argument('-o', '--output', default=None,
+                        help='output file (default: <segy_dir>/shots.h5)')
+    args = parser.parse_args()
+
+    h5_file = args.output or os.path.join(args.segy_dir, 'shots.h5')
+    segy_to_hdf5(args.segy_dir, h5_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Multiscale FWI example."""
+import numpy as np
+import os
+import h5py
+import json
+import time
+from dask_cluster import DaskCluster, MemoizedObjective
+from utils import save_model, resample_model
+
+
+def band_grid(shape, spacing, vmin, max_frequency, points_per_wavelength):
+    '''
+    Coarsest grid, with the extent of the model, that samples the shortest
+    wavelength of a frequency band with points_per_wavelength points. The time step
+    follows from the grid (critical time step of the model), so that it is the
+    largest one the band allows as well.
+
+    Args:
+        shape (tuple): shape of the grid of the model
+        spacing (tuple): spacing (m) of the grid of the model
+        vmin (float): lowest velocity (km/s)
+        max_frequency (float): highest frequency (kHz) of the band, None for the
+            full band
+        points_per_wavelength (float): grid points per shortest wavelength
+
+    Returns:
+        shape (tuple): shape of the grid of the band
+        spacing (tuple): spacing (m) of the grid of the band
+    '''
+    if max_frequency is None:
+        return shape, spacing
+    hmax = vmin / (max_frequency * points_per_wavelength)
+    extent = [(n - 1) * h for n, h in zip(shape, spacing)]
+    shape = tuple(min(n, int(np.ceil(e / hmax)) + 1) for n, e in zip(shape, extent))
+    spacing = tuple(e / (n - 1) for n, e in zip(shape, extent))
+    return shape, spacing
+
+
+def minimize_scipy(dc, objective, X, lb, ub, maxiter):
+    "L-BFGS-B of scipy.minimize; returns the final iterate"
+    from scipy.optimize import minimize, Bounds
+
+    # The next mini-batch of shots (shot_batch_size) is drawn after every iteration
+    solution_object = minimize(objective,
+                               X, jac=True, method='L-BFGS-B',
+                               bounds=Bounds(lb, ub),
+                               callback=lambda xk: dc.new_shot_batch(),
+                               options={'disp': True, 'maxiter': maxiter})
+    return solution_object.x.astype(np.float32)
+
+
+def minimize_nlopt(dc, objective, X, lb, ub, maxiter):
+    "L-BFGS of NLopt; returns the final iterate"
+    import nlopt
+
+    def myfunc(x, grad):
+        if grad.size > 0:
+            fcost, grad[:] = objective(x)
+        else:
+            fcost = objective.value(x)
+        return np.float64(fcost)
+
+    if dc.shot_batch_changes():
+        print("NLopt has no iteration callback: the first mini-batch of shots is "
+              "kept for the whole band")
+    opt = nlopt.opt(nlopt.LD_LBFGS, X.size)
+    opt.set_lower_bounds(lb)
+    opt.set_upper_bounds(ub)
+    opt.set_min_objective(myfunc)
+    opt.set_maxeval(maxiter)
+    opt.set_vector_storage(10)
+    return opt.optimize(X).astype(np.float32)
+
+
+def minimize_sotb(dc, objective, X, lb, ub, maxiter):
+    "L-BFGS of the SEISCOPE optimization toolbox; returns the final iterate"
+    from sotb_wrapper import interface
+
+    sotb = interface.sotb_wrapper()
+    fcost, grad = objective(X)
+    sotb.set_inputs(fcost, maxiter, nls_max=20, print_flag=1, debug=0)
+    flag = 0
+    while (flag != 2 and flag != 4):
+        flag = sotb.LBFGS(X.size, X, fcost, grad, flag, lb, ub)
+        if (flag == 1):
+            # compute cost and gradient at point x
+            fcost, grad = objective(X)
+        elif (flag == 3 and dc.shot_batch_changes()):
+            # new iterate: draw the next mini-batch of shots
+            dc.new_shot_batch()
+            fcost, grad = objective(X)
+    return X
+
+
+OPTIMIZERS = {'scipy': minimize_scipy, 'nlopt': minimize_nlopt,
+              'sotb': minimize_sotb}
+
+
+class ControlInversion:
+    '''
+    Class to control the multiscale (frequency continuation) inversion. The bands of
+    multiscale_bands (config.yaml) are inverted in turn, from the lowest one, each
+    with the observed data and the source low-passed to its highest frequency, on
+    the coarsest grid it allows (see band_grid), and with multiscale_maxiter
+    iterations of multiscale_optimizer. The result of a band, interpolated to the
+    grid of the next band, is the starting model of the next band.
+    '''
+
+    def run_inversion(self):
+        "Run the inversion workflow"
+        dc = DaskCluster()
+
+        parfile_path = dc.config_values['solver_params']['parfile_path']
+
+        # Read initial guess and metadata from hdf5 file
+        with h5py.File(parfile_path + 'vp_start.h5', 'r') as f:
+            v0 = f['vp_start'][()]
+            metadata = json.loads(f['metadata'][()])
+
+        dc.config_values['solver_params']['origin'] = (*metadata['origin'],)
+        shape = (*metadata['shape'],)
+        spacing = (*metadata['spacing'],)
+        vp = v0.reshape(shape).astype(np.float32)
+
+        # Define physical constraints on velocity - we know the
+        # maximum and minimum velocities we are expecting
+        vmax = dc.config_values['vmax']
+        vmin = dc.config_values['vmin']
+
+        # Check whether the specified path exists or not
+        results_path = parfile_path+'../results/'
+        isExist = os.path.exists(results_path)
+        if not isExist:
+            # Create a new directory because it does not exist
+            os.makedirs(results_path)
+
+        # bcast_data resolves some of the solver options in place (e.g.
+        # time_subsampling), so every band starts from the configured ones
+        solver_params = dict(dc.config_values['solver_params'])
+        mute_depth = dc.config_values['mute_depth']
+        minimize = OPTIMIZERS[dc.config_values['multiscale_optimizer']]
+        maxiter = dc.config_values['multiscale_maxiter']
+
+        start_time = time.time()
+        for band, max_frequency in enumerate(dc.config_values['multiscale_bands']):
+            band_shape, band_spacing = band_grid(
+                shape, spacing, vmin, max_frequency,
+                dc.config_values['points_per_wavelength'])
+            # The source follows the cell size of the grid of the band (see
+            # DaskCluster.band_source)
+            dc.config_values['solver_params'] = {
+                **solver_params, 'shape': band_shape, 'spacing': band_spacing,
+                'max_frequency': max_frequency,
+                'source_scale': float(np.prod(spacing) / np.prod(band_spacing))}
+            if mute_depth is not None:
+                dc.config_values['mute_depth'] = int(np.ceil(
+                    mute_depth * spacing[-1] / band_spacing[-1]))
+            # The specification of the band is sent to the workers by the first
+            # evaluation of the band
+            DaskCluster.gen_grad_cluster.counter = 0
+            print("Band {}: max frequency {} kHz, grid {} with spacing {}".format(
+                band, max_frequency, band_shape,
+                tuple(round(h, 2) for h in band_spacing)))
+
+            X = 1.0 / resample_model(vp, band_shape).reshape(-1)**2
+            n = X.size
+            lb = np.ones((n,), dtype=np.float32)*1.0/vmax**2  # in [s^2/km^2]
+            ub = np.ones((n,), dtype=np.float32)*1.0/vmin**2  # in [s^2/km^2]
+            # Points already evaluated in the band are not simulated again
+            objective = MemoizedObjective(dc)
+            X = minimize(dc, objective, X, lb, ub, maxiter)
+            objective.report()
+
+            vp = (1./np.sqrt(X)).reshape(band_shape).astype(np.float32)
+            save_model(results_path+'vp_band{}_multiscale.h5'.format(band), 'vp', vp,
+                       {**metadata, 'shape': band_shape, 'spacing': band_spacing})
+        elapsed_time = time.time() - start_time
+        time_format = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
+        print("Iterative inversion took :- {}".format(time_format))
+
+        # Save final model/image on the grid of the model
+        s = 'vp_final_result_multiscale'
+        save_model(results_path+s+'.h5', 'vp', resample_model(vp, shape), metadata)
+
+        del dc
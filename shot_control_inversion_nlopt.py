@@ -5,7 +5,7 @@ import os
 import h5py
 import json
 import time
-from dask_cluster import DaskCluster
+from dask_cluster import DaskCluster, MemoizedObjective
 from utils import save_model
  
 # appending a path
@@ -49,16 +49,24 @@ class ControlInversion:
             # Create a new directory because it does not exist
             os.makedirs(results_path)
 
+        # Points already evaluated are not simulated again
+        objective = MemoizedObjective(dc)
+
         def myfunc(x, grad):
             global count
             if count == 0:
                 print("%10s %15s %15s" % ("Iteration", "Function Val", "norm(g)"))
             if grad.size > 0:
-                fcost, grad[:] = dc.gen_grad_cluster(x)
+                fcost, grad[:] = objective(x)
+            else:
+                fcost = objective.value(x)
             count += 1
             print("{:10d} {:15.5e} {:15.5e}".format(count, fcost, np.linalg.norm(grad)))
             return np.float64(fcost)
 
+        if dc.shot_batch_changes():
+            print("NLopt has no iteration callback: the first mini-batch of shots "
+                  "is kept for the whole inversion")
         opt = nlopt.opt(nlopt.LD_LBFGS, int(np.prod(shape)))
         opt.set_lower_bounds(lb)
         opt.set_upper_bounds(ub)
@@ -75,6 +83,7 @@ class ControlInversion:
         elapsed_time = time.time() - start_time
         time_format = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
         print("Iterative inversion took :- {}".format(time_format))
+        objective.report()
 
         # Helpful console writings
         print('END OF TEST')
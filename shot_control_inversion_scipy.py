@@ -4,7 +4,7 @@ import os
 import h5py
 import json
 import time
-from dask_cluster import DaskCluster
+from dask_cluster import DaskCluster, MemoizedObjective
 from scipy.optimize import minimize, Bounds
 from utils import save_model
 
@@ -44,15 +44,21 @@ class ControlInversion:
             # Create a new directory because it does not exist
             os.makedirs(results_path)
 
+        # Points already evaluated are not simulated again
+        objective = MemoizedObjective(dc)
+
         start_time = time.time()
-        # Optimization loop
-        solution_object = minimize(dc.gen_grad_cluster,
+        # Optimization loop; the next mini-batch of shots (shot_batch_size) is drawn
+        # after every iteration
+        solution_object = minimize(objective,
                                    X, jac=True, method='L-BFGS-B',
                                    bounds=bounds,
+                                   callback=lambda xk: dc.new_shot_batch(),
                                    options={'disp': True, 'maxiter': 20})
         elapsed_time = time.time() - start_time
         time_format = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
         print("Iterative inversion took :- {}".format(time_format))
+        objective.report()
         s = 'vp_final_result_scipy_LBFGSB'
 
         # Save final model/image
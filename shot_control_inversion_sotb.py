@@ -4,7 +4,7 @@ import os
 import time
 import h5py
 import json
-from dask_cluster import DaskCluster
+from dask_cluster import DaskCluster, MemoizedObjective
 from sotb_wrapper import interface
 from utils import save_model
 
@@ -55,9 +55,12 @@ class ControlInversion:
         niter_max = 20  # maximum iteration number
         nls_max = 20  # maximum line-search number
 
+        # Points already evaluated are not simulated again
+        objective = MemoizedObjective(dc)
+
         # computation of the cost and gradient associated
         # with the initial guess
-        fcost, grad = dc.gen_grad_cluster(X)
+        fcost, grad = objective(X)
 
         # Set some fields of the UserDefined derived type in Fortran (ctype structure).
         # parameter initialization
@@ -78,10 +81,16 @@ class ControlInversion:
             flag = sotb.LBFGS(n, X, fcost, grad, flag, lb, ub)
             if (flag == 1):
                 # compute cost and gradient at point x
-                fcost, grad = dc.gen_grad_cluster(X)
+                fcost, grad = objective(X)
+            elif (flag == 3 and dc.shot_batch_changes()):
+                # new iterate: draw the next mini-batch of shots (shot_batch_size)
+                # and restart the line search from the cost and gradient of x
+                dc.new_shot_batch()
+                fcost, grad = objective(X)
         elapsed_time = time.time() - start_time
         time_format = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
         print("Iterative inversion took :- {}".format(time_format))
+        objective.report()
 
         # Helpful console writings
         print('END OF TEST')
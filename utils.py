@@ -2,10 +2,13 @@
 # coding: utf-8
 
 # basic imports.
+import os
+import functools
 import numpy as np
 import segyio as so
 import h5py
 import json
+from scipy import ndimage
 
 
 def expand_array(arr, nbl):
@@ -91,6 +94,28 @@ def segy_write(data, sourceX, sourceZ, groupX, groupZ, dt, filename, sourceY=Non
     Returns:
         None
     """
+    traces = segy_traces(data, sourceX, sourceZ, groupX, groupZ, dt, sourceY=sourceY,
+                         groupY=groupY, elevScalar=elevScalar,
+                         coordScalar=coordScalar)
+    segy_create(filename, len(traces), data.shape[0], dt)
+    segy_write_traces(filename, 0, traces)
+    return
+
+
+def segy_traces(data, sourceX, sourceZ, groupX, groupZ, dt, sourceY=None, groupY=None,
+                elevScalar=-1000, coordScalar=-1000, fldr=1, position=0):
+    """
+    Build the trace headers and samples of a shot as laid out in a SEG-Y file (see
+    segy_write for the arguments).
+
+    Args:
+        fldr (int, optional): Field record number of the shot (default is 1).
+        position (int, optional): Position of the first trace of the shot in the file,
+                                  for the trace sequence numbers (default is 0).
+
+    Returns:
+        numpy.ndarray: Structured array with a 'header' and a 'data' field per trace.
+    """
     nt = data.shape[0]
     nxrec = len(groupX)
 
@@ -98,38 +123,86 @@ def segy_write(data, sourceX, sourceZ, groupX, groupZ, dt, filename, sourceY=Non
         sourceY = np.zeros(1, dtype='int')
         groupY = np.zeros(nxrec, dtype='int')
 
-    # Create spec object
+    traces = np.zeros(nxrec, dtype=_segy_trace_dtype(nt))
+    hdr = traces['header']
+    hdr['tracl'] = hdr['tracr'] = np.arange(position + 1, position + nxrec + 1)
+    hdr['tracf'] = np.arange(1, nxrec + 1)
+    hdr['fldr'] = fldr
+    hdr['sx'] = np.round(sourceX[0] * np.abs(coordScalar))
+    hdr['sy'] = np.round(sourceY[0] * np.abs(coordScalar))
+    hdr['selev'] = np.round(sourceZ[0] * np.abs(elevScalar))
+    hdr['gx'] = np.round(np.asarray(groupX) * np.abs(coordScalar))
+    hdr['gy'] = np.round(np.asarray(groupY) * np.abs(coordScalar))
+    hdr['gelev'] = np.round(np.asarray(groupZ) * np.abs(elevScalar))
+    hdr['ns'] = nt
+    hdr['dt'] = int(dt*1e3)
+    hdr['scalel'] = int(elevScalar)
+    hdr['scalco'] = int(coordScalar)
+    traces['data'] = np.asarray(data).T
+    return traces
+
+
+def segy_create(filename, ntraces, nt, dt, ensemble_traces=None):
+    """
+    Create a SEG-Y file for ntraces traces of nt IEEE float samples: write the
+    textual and binary headers and extend the file to its final size, so that the
+    traces can be written at their positions (see segy_write_traces).
+
+    Args:
+        filename (str): Name of the output SEG-Y file.
+        ntraces (int): Number of traces of the file.
+        nt (int): Number of samples per trace.
+        dt (float): Time sample interval in milliseconds.
+        ensemble_traces (int, optional): Number of traces per shot (default is
+                                         ntraces).
+    """
+    # Create spec object; segyio writes the textual and binary headers only
     spec = so.spec()
-    spec.ilines = np.arange(nxrec)    # dummy trace count
-    spec.xlines = np.zeros(1, dtype='int')  # assume coords are already vectorized for 3D
+    spec.tracecount = ntraces
     spec.samples = range(nt)
-    spec.format = 1
-    spec.sorting = 1
+    spec.format = 5
     with so.create(filename, spec) as segyfile:
-        for i in range(nxrec):
-            segyfile.bin = {
-                so.BinField.Samples: data.shape[0],
-                so.BinField.Traces: data.shape[1],
-                so.BinField.Interval: int(dt*1e3)
-            }
-            segyfile.header[i] = {
-                so.su.tracl: i+1,
-                so.su.tracr: i+1,
-                so.su.fldr: 1,
-                so.su.tracf: i+1,
-                so.su.sx: int(np.round(sourceX[0] * np.abs(coordScalar))),
-                so.su.sy: int(np.round(sourceY[0] * np.abs(coordScalar))),
-                so.su.selev: int(np.round(sourceZ[0] * np.abs(elevScalar))),
-                so.su.gx: int(np.round(groupX[i] * np.abs(coordScalar))),
-                so.su.gy: int(np.round(groupY[i] * np.abs(coordScalar))),
-                so.su.gelev: int(np.round(groupZ[i] * np.abs(elevScalar))),
-                so.su.dt: int(dt*1e3),
-                so.su.scalel: int(elevScalar),
-                so.su.scalco: int(coordScalar)
-            }
-            segyfile.trace[i] = data[:, i]
-        segyfile.dt = int(dt*1e3)
-    return
+        segyfile.bin = {
+            so.BinField.Samples: nt,
+            so.BinField.Traces: ensemble_traces or ntraces,
+            so.BinField.Interval: int(dt*1e3),
+            so.BinField.TraceFlag: 1
+        }
+    with open(filename, 'r+b') as f:
+        # SEG-Y revision 1, which defines the IEEE float format
+        f.seek(int(so.BinField.SEGYRevision) - 1)
+        f.write(np.array(0x0100, dtype='>u2').tobytes())
+        f.truncate(3600 + ntraces * _segy_trace_dtype(nt).itemsize)
+
+
+def segy_write_traces(filename, position, traces):
+    """
+    Write traces (see segy_traces) into a SEG-Y file created by segy_create, from
+    the trace at position on.
+    """
+    with open(filename, 'r+b') as f:
+        f.seek(3600 + position * traces.dtype.itemsize)
+        traces.tofile(f)
+
+
+def _segy_trace_dtype(nt):
+    """
+    NumPy dtype of a trace of a SEG-Y file with nt IEEE float samples: the big-endian
+    trace header fields written by segy_write, at their byte offsets, followed by
+    the samples.
+    """
+    fields = {'tracl': (so.su.tracl, '>i4'), 'tracr': (so.su.tracr, '>i4'),
+              'fldr': (so.su.fldr, '>i4'), 'tracf': (so.su.tracf, '>i4'),
+              'gelev': (so.su.gelev, '>i4'), 'selev': (so.su.selev, '>i4'),
+              'scalel': (so.su.scalel, '>i2'), 'scalco': (so.su.scalco, '>i2'),
+              'sx': (so.su.sx, '>i4'), 'sy': (so.su.sy, '>i4'),
+              'gx': (so.su.gx, '>i4'), 'gy': (so.su.gy, '>i4'),
+              'ns': (so.su.ns, '>i2'), 'dt': (so.su.dt, '>i2')}
+    header = np.dtype({'names': list(fields),
+                       'formats': [f for _, f in fields.values()],
+                       'offsets': [int(b) - 1 for b, _ in fields.values()],
+                       'itemsize': 240})
+    return np.dtype([('header', header), ('data', '>f4', (nt,))])
 
 
 def segy_read(filename, ndims=2):
@@ -189,38 +262,41 @@ def segy_read(filename, ndims=2):
         elif elevSc > 0.:
             groupZ = groupZ * np.abs(elevSc)
 
-        nrec = len(groupX)
-        nt = len(segyfile.trace[0])
-
         # Extract data
-        data = np.zeros(shape=(nt, nrec), dtype='float32')
-        for i in range(nrec):
-            data[:, i] = segyfile.trace[i]
+        data = segyfile.trace.raw[:].T
+        nt = data.shape[0]
         tmax = (nt-1)*dt
 
     if ndims == 2:
-        return data, np.vstack((sourceX, sourceZ)).T,
-        np.vstack((groupX, groupZ)).T, tmax, dt, nt
+        return (data, np.vstack((sourceX, sourceZ)).T,
+                np.vstack((groupX, groupZ)).T, tmax, dt, nt)
     else:
-        return data, np.vstack((sourceX, sourceY, sourceZ)).T,
-        np.vstack((groupX, groupY, groupZ)).T, tmax, dt, nt
+        return (data, np.vstack((sourceX, sourceY, sourceZ)).T,
+                np.vstack((groupX, groupY, groupZ)).T, tmax, dt, nt)
 
 
-def make_lookup_table(sgy_file):
+def make_lookup_table(sgy_file, cache=True):
     """
     Create a lookup table of shot records based on SEG-Y header information.
 
-    This function scans a SEG-Y file and organizes shot records into a dictionary
-    where the keys are the unique shot record IDs, and the values are dictionaries
-    containing information about each shot record.
+    This function reads the trace headers of a SEG-Y file in bulk and organizes shot
+    records into a dictionary where the keys are the unique shot record IDs, and the
+    values are dictionaries containing information about each shot record. A new shot
+    starts wherever the record ID changes from one trace to the next. The index is
+    persisted to a sidecar file (sgy_file + '.idx.npz') keyed by the size and
+    modification time of the SEG-Y file, so that later calls load it without
+    reading the headers.
 
     Args:
         sgy_file (str): The path to the SEG-Y file to process.
+        cache (bool, optional): Whether to use and write the sidecar index.
+            Default True.
 
     Returns:
         dict: A dictionary containing shot record information with shot IDs as keys.
               Each entry includes the filename, trace position, number of traces, source
-              coordinates, and receiver coordinates for the corresponding shot record.
+              coordinates, and receiver coordinates (array of shape (traces, 3)) for
+              the corresponding shot record.
 
     Example:
         >>> sgy_lookup = make_lookup_table('data.segy')
@@ -229,43 +305,239 @@ def make_lookup_table(sgy_file):
         ...       f"Number of Traces: {shot_info['Num_Traces']}")
 
     """
+    st = os.stat(sgy_file)
+    stamp = np.array([st.st_size, st.st_mtime_ns])
+    index_file = sgy_file + '.idx.npz'
+    index = None
+    if cache and os.path.isfile(index_file):
+        try:
+            with np.load(index_file) as npz:
+                if np.array_equal(npz['stamp'], stamp):
+                    index = {k: npz[k] for k in npz.files}
+        except (OSError, ValueError, KeyError):
+            index = None
+    if index is None:
+        index = _segy_header_index(sgy_file)
+        if cache:
+            save_segy_index(sgy_file, index)
+
     tbl = {}
+    ids, starts, counts = index['ids'], index['starts'], index['counts']
+    for i in range(len(ids)):
+        start, n = int(starts[i]), int(counts[i])
+        tbl[int(ids[i])] = {'filename': sgy_file,
+                            'Trace_Position': start,
+                            'Num_Traces': n,
+                            'Source': tuple(float(x) for x in index['sources'][i]),
+                            'Receivers': index['receivers'][start:start + n]}
+
+    return tbl
+
+
+def save_segy_index(sgy_file, index):
+    """
+    Save the shot index of a SEG-Y file (see _segy_header_index) to its sidecar file,
+    keyed by the current size and modification time of the SEG-Y file. Nothing is
+    saved if the directory is not writable.
+    """
+    st = os.stat(sgy_file)
+    try:
+        np.savez(sgy_file + '.idx.npz', stamp=np.array([st.st_size, st.st_mtime_ns]),
+                 **index)
+    except OSError:
+        pass
+
+
+def segy_index(sources, receivers, counts, elevScalar=-1000, coordScalar=-1000):
+    """
+    Shot index (see _segy_header_index) of a SEG-Y file written shot after shot with
+    segy_traces, with field record numbers 1, 2, ..., computed from the geometry
+    instead of the trace headers.
+
+    Args:
+        sources (numpy.ndarray): Source coordinates (X, Y, Z) of the shots.
+        receivers (numpy.ndarray): Receiver coordinates (X, Y, Z) of all the traces.
+        counts (numpy.ndarray): Number of traces of every shot.
+        elevScalar (int, optional): Elevation scalar (default is -1000).
+        coordScalar (int, optional): Coordinate scalar (default is -1000).
+    """
+    def quantize(x, scalar):
+        # Values as stored in the headers and scaled back by make_lookup_table
+        x = np.round(np.asarray(x, dtype=np.float64) * abs(scalar)).astype(np.int32)
+        return x * (abs(1. / scalar) if scalar < 0 else scalar)
+
+    scalers = (coordScalar, coordScalar, elevScalar)
+    counts = np.asarray(counts)
+    return {'ids': np.arange(1, len(counts) + 1, dtype=np.int32),
+            'starts': np.cumsum(counts) - counts,
+            'counts': counts,
+            'sources': np.stack([quantize(np.asarray(sources)[:, i], scalers[i])
+                                 for i in range(3)], axis=-1),
+            'receivers': np.stack([quantize(np.asarray(receivers)[:, i], scalers[i])
+                                   for i in range(3)], axis=-1)}
+
+
+def _segy_header_index(sgy_file):
+    """
+    Read the shot index of a SEG-Y file (see make_lookup_table) from the trace
+    header attributes.
+
+    Returns:
+        dict: Record IDs, first traces and numbers of traces of the shots, source
+            coordinates (shots, 3) and receiver coordinates (traces, 3).
+    """
+    def scalar(s):
+        s = s.astype(np.float64)
+        return np.where(s < 0, np.abs(1. / np.where(s < 0, s, 1.)), s)
+
     with so.open(sgy_file, ignore_geometry=True) as f:
         f.mmap()
-        idx = None
-        pos_in_file = 0
-        for hdr in f.header:
-            if int(hdr[so.TraceField.SourceGroupScalar]) < 0:
-                scalco = abs(1./hdr[so.TraceField.SourceGroupScalar])
-            else:
-                scalco = hdr[so.TraceField.SourceGroupScalar]
-            if int(hdr[so.TraceField.ElevationScalar]) < 0:
-                scalel = abs(1./hdr[so.TraceField.ElevationScalar])
-            else:
-                scalel = hdr[so.TraceField.ElevationScalar]
-            # Check to see if we're in a new shot
-            if idx != hdr[so.TraceField.FieldRecord]:
-                idx = hdr[so.TraceField.FieldRecord]
-                tbl[idx] = {}
-                tbl[idx]['filename'] = sgy_file
-                tbl[idx]['Trace_Position'] = pos_in_file
-                tbl[idx]['Num_Traces'] = 1
-                tbl[idx]['Source'] = (hdr[so.TraceField.SourceX]*scalco,
-                                      hdr[so.TraceField.SourceY]*scalco,
-                                      hdr[so.TraceField.SourceSurfaceElevation] *
-                                      scalel)
-                tbl[idx]['Receivers'] = []
-            else:  # Not in a new shot, so increase the number of traces in the shot by 1
-                tbl[idx]['Num_Traces'] += 1
-            tbl[idx]['Receivers'].append((hdr[so.TraceField.GroupX]*scalco,
-                                         hdr[so.TraceField.GroupY]*scalco,
-                                         hdr[so.TraceField.ReceiverGroupElevation] *
-                                         scalel))
-            pos_in_file += 1
+        attr = {k: f.attributes(k)[:] for k in (
+            so.TraceField.FieldRecord, so.TraceField.SourceGroupScalar,
+            so.TraceField.ElevationScalar, so.TraceField.SourceX,
+            so.TraceField.SourceY, so.TraceField.SourceSurfaceElevation,
+            so.TraceField.GroupX, so.TraceField.GroupY,
+            so.TraceField.ReceiverGroupElevation)}
+
+    ffid = attr[so.TraceField.FieldRecord]
+    scalco = scalar(attr[so.TraceField.SourceGroupScalar])
+    scalel = scalar(attr[so.TraceField.ElevationScalar])
+    starts = np.flatnonzero(np.diff(ffid, prepend=ffid[:1] - 1) != 0) if len(ffid) \
+        else np.zeros(0, dtype=np.int64)
+    counts = np.diff(np.append(starts, len(ffid)))
+    sources = np.stack([attr[so.TraceField.SourceX] * scalco,
+                        attr[so.TraceField.SourceY] * scalco,
+                        attr[so.TraceField.SourceSurfaceElevation] * scalel],
+                       axis=-1)[starts]
+    receivers = np.stack([attr[so.TraceField.GroupX] * scalco,
+                          attr[so.TraceField.GroupY] * scalco,
+                          attr[so.TraceField.ReceiverGroupElevation] * scalel], axis=-1)
+
+    return {'ids': ffid[starts], 'starts': starts, 'counts': counts,
+            'sources': sources, 'receivers': receivers}
+
+
+def make_tasks_table(sgy_files):
+    """
+    Create a lookup table of the shot records of several SEG-Y files (see
+    make_lookup_table). The shot with record ID 1 of the n-th file gets the ID str(n),
+    as every file written by the forward modeling holds a single shot.
+
+    Args:
+        sgy_files (list): The paths to the SEG-Y files to process.
 
+    Returns:
+        dict: A dictionary containing shot record information with shot IDs as keys.
+    """
+    tbl = {}
+    for count, sfile in enumerate(sgy_files, start=1):
+        tbl.update({str(count) if k == 1 else k: v
+                    for k, v in make_lookup_table(sfile).items()})
     return tbl
 
 
+def create_hdf5_store(h5_file, ids, sources, receivers, nsamples, dt):
+    """
+    Create an HDF5 shot store (see segy_to_hdf5.py) for the given shots: a float32
+    dataset 'data' of shape (nshots, nsamples, max_traces) with one uncompressed
+    chunk per shot, allocated when the file is created so that the shots can be
+    written at fixed offsets (see hdf5_write_shot), and the geometry of the shots.
+
+    Args:
+        h5_file (str): The path to the HDF5 shot store.
+        ids (list): The shot IDs.
+        sources (numpy.ndarray): Source coordinates (X, Y, Z) of the shots.
+        receivers (list): Receiver coordinates (X, Y, Z) of every shot.
+        nsamples (int): Number of samples per trace.
+        dt (float): Sample interval in milliseconds.
+    """
+    nshots = len(ids)
+    num_traces = np.array([len(r) for r in receivers])
+    max_traces = num_traces.max()
+    padded = np.zeros((nshots, max_traces, 3))
+    for i, r in enumerate(receivers):
+        padded[i, :len(r)] = r
+
+    with h5py.File(h5_file, 'w') as f:
+        dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+        dcpl.set_chunk((1, nsamples, max_traces))
+        dcpl.set_alloc_time(h5py.h5d.ALLOC_TIME_EARLY)
+        dcpl.set_fill_value(np.zeros(1, dtype=np.float32))
+        space = h5py.h5s.create_simple((nshots, nsamples, max_traces))
+        h5py.h5d.create(f.id, b'data', h5py.h5t.NATIVE_FLOAT, space, dcpl=dcpl)
+        f['data'].attrs['dt'] = dt
+        f.create_dataset('id', data=np.array([str(k).encode() for k in ids]))
+        f.create_dataset('num_traces', data=num_traces)
+        f.create_dataset('source', data=np.asarray(sources, dtype=np.float64))
+        f.create_dataset('receivers', data=padded)
+
+
+def hdf5_write_shot(h5_file, position, data):
+    """
+    Write a shot (array of shape (nsamples, traces)) into its chunk of an HDF5 shot
+    store created by create_hdf5_store. The chunk is written directly to the file,
+    so that several processes can fill the store at the same time.
+    """
+    # The layout is read on every call, as the cached one (_hdf5_layout) is keyed
+    # by the modification time, which changes with every write
+    offsets, shape, _ = _read_hdf5_layout(h5_file)
+    block = np.zeros(shape, dtype=np.float32)
+    block[:, :data.shape[1]] = data
+    with open(h5_file, 'r+b') as f:
+        f.seek(offsets[position])
+        block.tofile(f)
+
+
+def make_hdf5_lookup_table(h5_file):
+    """
+    Create a lookup table of the shot records of an HDF5 shot store (see
+    segy_to_hdf5.py), with the same entries as make_lookup_table. The trace position
+    of a shot is its index in the store.
+
+    Args:
+        h5_file (str): The path to the HDF5 shot store.
+
+    Returns:
+        dict: A dictionary containing shot record information with shot IDs as keys.
+    """
+    tbl = {}
+    with h5py.File(h5_file, 'r') as f:
+        ids = f['id'][()]
+        num_traces = f['num_traces'][()]
+        sources = f['source'][()]
+        receivers = f['receivers'][()]
+    for i, idx in enumerate(ids):
+        n = int(num_traces[i])
+        tbl[idx.decode()] = {'filename': h5_file,
+                             'Trace_Position': i,
+                             'Num_Traces': n,
+                             'Source': tuple(sources[i]),
+                             'Receivers': receivers[i, :n]}
+    return tbl
+
+
+def resample_model(data, shape):
+    """
+    Resample a model onto a grid of another shape with the same extent.
+
+    The first and last nodes of every axis are kept in place and the values in
+    between are interpolated linearly, so that the model can be moved between the
+    grids of the frequency bands of a multiscale inversion.
+
+    Args:
+        data (numpy.ndarray): The model on its grid.
+        shape (tuple): The shape of the new grid.
+
+    Returns:
+        numpy.ndarray: The model on the new grid, with the dtype of data.
+    """
+    shape = tuple(shape)
+    if data.shape == shape:
+        return data
+    zoom = [n / m for n, m in zip(shape, data.shape)]
+    return ndimage.zoom(data, zoom, order=1, mode='nearest').astype(data.dtype)
+
+
 def save_model(model_name, datakey, data, metadata, dtype=np.float32):
     """
     Save model data and associated metadata to an HDF5 file.
@@ -294,35 +566,105 @@ def save_model(model_name, datakey, data, metadata, dtype=np.float32):
 
 def load_shot(filename, position, traces_in_shot):
     """
-    Load a shot record from a SEG-Y file and return shot data, maximum time,
-    and sample interval.
+    Load a shot record from a SEG-Y file or an HDF5 shot store and return shot data,
+    maximum time, and sample interval.
 
     Args:
-        filename (str): The path to the SEG-Y file containing the shot record.
-        position (int): The position of the first trace of the shot in the file.
+        filename (str): The path to the SEG-Y file (or .h5 shot store) containing the
+            shot record.
+        position (int): The position of the first trace of the shot in the file (the
+            index of the shot in a shot store).
         traces_in_shot (int): The number of traces in the shot.
 
     Returns:
         tuple: A tuple containing the following elements:
-            - numpy.ndarray: Shot data as a 2D NumPy array with shape (nsamples, traces).
+            - numpy.ndarray: Shot data as a 2D float32 NumPy array with shape
+              (nsamples, traces).
             - float: Maximum time (tmax) in seconds.
             - float: Sample interval (samp_int) in milliseconds.
 
     Raises:
         RuntimeError: If an exception occurs while reading the SEG-Y file.
 
+    """
+    if filename.endswith('.h5'):
+        return load_hdf5_shot(filename, position, traces_in_shot)
+    shots = load_shots(filename, [(position, traces_in_shot)])
+    if shots is not None:
+        return shots[0]
+
+
+def load_shots(filename, shots):
+    """
+    Load several shot records from a SEG-Y file with one open (memory-mapped) file
+    handle. The traces of every shot are read as a single float32 block.
+
+    Args:
+        filename (str): The path to the SEG-Y file containing the shot records.
+        shots (list): (position of the first trace, number of traces) of every shot.
+
+    Returns:
+        list: A (shot data, tmax, samp_int) tuple per shot, as returned by load_shot.
+            The shot data are the transposed views of the blocks of traces.
+
+    Raises:
+        RuntimeError: If an exception occurs while reading the SEG-Y file.
+
     """
     try:
         with so.open(filename, ignore_geometry=True) as f:
+            f.mmap()
             num_samples = len(f.samples)
             samp_int = f.bin[so.BinField.Interval] / 1000.
-            retrieved_shot = np.zeros((num_samples, traces_in_shot))
-            shot_traces = f.trace[position:position + traces_in_shot]
-            for i, trace in enumerate(shot_traces):
-                retrieved_shot[:, i] = trace
+            tmax = (num_samples - 1) * samp_int
+            return [(f.trace.raw[position:position + traces_in_shot].T, tmax, samp_int)
+                    for position, traces_in_shot in shots]
+    except RuntimeError as e:
+        print("Caught an exception:", e)
 
-        tmax = (num_samples - 1) * samp_int
 
-        return retrieved_shot, tmax, samp_int
-    except RuntimeError as e:
-        print("Caught an exception:", e)
\ No newline at end of file
+def _read_hdf5_layout(filename):
+    """
+    Return the byte offsets of the shots (chunks) of an HDF5 shot store in the file,
+    the shape of a shot and the sample interval.
+    """
+    with h5py.File(filename, 'r') as f:
+        dset = f['data']
+        offsets = [dset.id.get_chunk_info_by_coord((i, 0, 0)).byte_offset
+                   for i in range(dset.shape[0])]
+        return offsets, dset.shape[1:], float(dset.attrs['dt'])
+
+
+@functools.lru_cache(maxsize=8)
+def _hdf5_layout(filename, stamp):
+    """
+    Return the layout of an HDF5 shot store (see _read_hdf5_layout), read once per
+    process and file version (stamp).
+    """
+    return _read_hdf5_layout(filename)
+
+
+def load_hdf5_shot(filename, position, traces_in_shot):
+    """
+    Load a shot record from an HDF5 shot store (see segy_to_hdf5.py). Every shot is
+    a single uncompressed chunk of the store, so it is read from the file with one
+    call, without going through HDF5.
+
+    Args:
+        filename (str): The path to the HDF5 shot store.
+        position (int): The index of the shot in the store.
+        traces_in_shot (int): The number of traces in the shot.
+
+    Returns:
+        tuple: Shot data as a float32 array with shape (nsamples, traces), maximum
+            time and sample interval (ms).
+    """
+    st = os.stat(filename)
+    offsets, shape, samp_int = _hdf5_layout(filename, (st.st_mtime_ns, st.st_size))
+    retrieved_shot = np.fromfile(filename, dtype=np.float32, count=int(np.prod(shape)),
+                                 offset=offsets[position]).reshape(shape)
+    retrieved_shot = np.ascontiguousarray(retrieved_shot[:, :traces_in_shot])
+
+    tmax = (retrieved_shot.shape[0] - 1) * samp_int
+
+    return retrieved_shot, tmax, samp_int
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# basic imports.
+import os
+import time
+import zlib
+import tempfile
+import numpy as np
+
+
+class WavefieldStore:
+    '''
+    Storage for the time slices of a forward wavefield. The wavefield is written
+    and read in blocks of consecutive time steps. This base class keeps the slices
+    uncompressed in memory.
+
+    Args:
+        nt (int): Number of time steps
+        shape (tuple): Shape of a single time slice
+        dtype (numpy.dtype, optional): Data type of the wavefield. Default float32
+    '''
+
+    def __init__(self, nt, shape, dtype=np.float32):
+        self.nt = nt
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._allocate()
+
+    def _allocate(self):
+        self.data = np.zeros((self.nt,) + self.shape, dtype=self.dtype)
+
+    def write(self, start, block):
+        '''
+        Store the time slices block[0], block[1], ... as time steps start,
+        start+1, ...
+        '''
+        self.data[start:start + len(block)] = block
+
+    def read(self, start, stop, out):
+        '''
+        Copy the time steps start, ..., stop-1 into out
+        '''
+        out[:] = self.data[start:stop]
+
+    @property
+    def raw_nbytes(self):
+        '''Size in bytes of the uncompressed wavefield'''
+        return self.nt * int(np.prod(self.shape)) * self.dtype.itemsize
+
+    @property
+    def nbytes(self):
+        '''Size in bytes of the stored wavefield'''
+        return self.data.nbytes
+
+    @property
+    def compression_ratio(self):
+        return self.raw_nbytes / max(self.nbytes, 1)
+
+    def close(self):
+        '''Release the storage'''
+        self.data = None
+
+
+class Float16Store(WavefieldStore):
+    '''
+    Keeps the time slices in half precision.
+    '''
+
+    def _allocate(self):
+        self.data = np.zeros((self.nt,) + self.shape, dtype=np.float16)
+
+    def write(self, start, block):
+        self.data[start:start + len(block)] = block.astype(np.float16)
+
+
+class LossyStore(WavefieldStore):
+    '''
+    Tolerance-bounded lossy compression of the time slices. Every slice is
+    quantized with a uniform step of 2*tol*max(|slice|), so that the absolute
+    error is at most tol times the peak amplitude of the slice, and the integers
+    are packed with deflate. Slices the wave has not reached yet cost a few bytes.
+
+    Args:
+        nt (int): Number of time steps
+        shape (tuple): Shape of a single time slice
+        dtype (numpy.dtype, optional): Data type of the wavefield. Default float32
+        tol (float, optional): Error bound relative to the slice peak. Default 1e-3
+    '''
+
+    def __init__(self, nt, shape, dtype=np.float32, tol=1e-3):
+        if not 1./65534 <= tol < 1:
+            raise ValueError("tol must be in [1/65534, 1)")
+        self.tol = tol
+        self.qtype = np.int8 if tol >= 1./254 else np.int16
+        super().__init__(nt, shape, dtype)
+
+    def _allocate(self):
+        self.data = [None] * self.nt
+        self.steps = np.zeros(self.nt, dtype=np.float32)
+
+    def write(self, start, block):
+        for i in range(len(block)):
+            s = np.asarray(block[i])
+            step = 2. * self.tol * np.abs(s).max()
+            self.steps[start + i] = step
+            if step == 0:
+                self.data[start + i] = b''
+                continue
+            q = np.rint(s / step).astype(self.qtype)
+            self.data[start + i] = zlib.compress(q.tobytes(), 1)
+
+    def read(self, start, stop, out):
+        for i in range(start, stop):
+            if self.steps[i] == 0:
+                out[i - start] = 0.
+                continue
+            q = np.frombuffer(zlib.decompress(self.data[i]), dtype=self.qtype)
+            out[i - start] = q.reshape(self.shape) * self.steps[i]
+
+    @property
+    def nbytes(self):
+        return sum(len(c) for c in self.data if c is not None) + self.steps.nbytes
+
+
+class MemmapStore(WavefieldStore):
+    '''
+    Keeps the time slices in a file on (node-local) scratch. Every block of time
+    steps is written and read through its own memory map, which is released
+    afterwards, so that the wavefield is not kept in the memory of the process.
+    The file is removed as soon as it is created and disappears when the store is
+    closed, even if the process dies. The time spent in the I/O is recorded.
+
+    Args:
+        nt (int): Number of time steps
+        shape (tuple): Shape of a single time slice
+        dtype (numpy.dtype, optional): Data type of the wavefield. Default float32
+        scratch_path (str, optional): Directory of the file. Default None, i.e., the
+            directory of tempfile (TMPDIR)
+    '''
+
+    def __init__(self, nt, shape, dtype=np.float32, scratch_path=None):
+        self.scratch_path = scratch_path
+        self.bytes_written = self.bytes_read = 0
+        self.write_time = self.read_time = 0.
+        super().__init__(nt, shape, dtype)
+
+    def _allocate(self):
+        fd, path = tempfile.mkstemp(suffix='.wavefield', dir=self.scratch_path)
+        self.file = os.fdopen(fd, 'w+b')
+        os.unlink(path)
+        self.file.truncate(self.raw_nbytes)
+        self.slice_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def _map(self, start, stop, mode):
+        return np.memmap(self.file, dtype=self.dtype, mode=mode,
+                         offset=start * self.slice_nbytes,
+                         shape=(stop - start,) + self.shape)
+
+    def write(self, start, block):
+        tic = time.perf_counter()
+        mm = self._map(start, start + len(block), 'r+')
+        mm[:] = block
+        mm.flush()
+        del mm
+        self.write_time += time.perf_counter() - tic
+        self.bytes_written += len(block) * self.slice_nbytes
+
+    def read(self, start, stop, out):
+        tic = time.perf_counter()
+        mm = self._map(start, stop, 'r')
+        out[:] = mm
+        del mm
+        self.read_time += time.perf_counter() - tic
+        self.bytes_read += (stop - start) * self.slice_nbytes
+
+    @property
+    def nbytes(self):
+        '''Size in bytes of the wavefield kept in memory'''
+        return 0
+
+    @property
+    def write_bandwidth(self):
+        '''Write bandwidth in bytes per second'''
+        return self.bytes_written / max(self.write_time, 1e-12)
+
+    @property
+    def read_bandwidth(self):
+        '''Read bandwidth in bytes per second'''
+        return self.bytes_read / max(self.read_time, 1e-12)
+
+    def close(self):
+        self.file.close()
+
+
+def make_store(solver_params, nt, shape, dtype=np.float32):
+    '''
+    Create the wavefield store selected in solver_params (see
+    DaskCluster.grad_fwi_in_worker).
+    '''
+    if solver_params['compression'] == 'float16':
+        return Float16Store(nt, shape, dtype)
+    elif solver_params['compression'] == 'lossy':
+        return LossyStore(nt, shape, dtype, tol=solver_params['compression_tol'])
+    else:
+        raise ValueError("Invalid compression: {}".format(solver_params['compression']))